@@ -1,59 +1,49 @@
 import io
+import os
+import time
+import asyncio
 from io import BytesIO
 
-import requests
+import aiohttp
 import gradio_client.exceptions
 
-from gradio_client import Client
-from typing import Union, Dict, Any
+from typing import Union, Dict, Any, Awaitable, Callable, Optional
 
-from registry import TextToImgModel, ModelInfo, register_model
+from registry import AIRegistry, TextToImgModel, ModelInfo, register_model
+from utils.gradio_pool import GradioClientPool
+from utils.http import download_bytes
+from utils.latency import get_latency_histogram
+from utils.rate_limit import get_admission_controller
+
+# Хеджирование: если основной Space не ответил за порог (p95 его недавних задержек,
+# ограниченный MIN/MAX), параллельно запускается резервный, берется первый успешный ответ.
+FLUX_HEDGE_ENABLED = os.getenv('FLUX_HEDGE_ENABLED', '1') == '1'
+FLUX_HEDGE_QUANTILE = float(os.getenv('FLUX_HEDGE_QUANTILE', '0.95'))
+FLUX_HEDGE_MIN_DELAY = float(os.getenv('FLUX_HEDGE_MIN_DELAY', '5'))
+FLUX_HEDGE_MAX_DELAY = float(os.getenv('FLUX_HEDGE_MAX_DELAY', '30'))
+FLUX_HEDGE_DEFAULT_DELAY = float(os.getenv('FLUX_HEDGE_DEFAULT_DELAY', '15'))
+FLUX_HEDGE_MIN_SAMPLES = int(os.getenv('FLUX_HEDGE_MIN_SAMPLES', '10'))
+
+
+def hedge_delays() -> Dict[str, float]:
+    """Текущий порог хеджирования для каждого основного Space FLUX с резервным (выводится в метриках)."""
+    return {model.gradio_space_id: model.hedge_delay()
+            for model in AIRegistry().get_models_for_provider(FluxGradioBaseModel.provider)
+            if getattr(model, "backup_gradio_space_id", None)}
 
 
 class FluxGradioBaseModel(TextToImgModel):
     provider = "FLUX"
+    gradio_space_id: str
+    default_predict_params: Dict[str, Any]
 
-    def __init__(self,
-                 gradio_space_id: str,
-                 model_version: str,
-                 description: str,
-                 default_predict_params: Dict[str, Any],
-                 capabilities: tuple = (TextToImgModel,)):
-        self.gradio_space_id = gradio_space_id
-        self.default_predict_params = default_predict_params
-
-        self.meta = ModelInfo(
-            provider=self.provider,
-            version=model_version,
-            description=description + " (Запросы только на английском).",
-            capabilities=capabilities,
-            is_async=False
-        )
+    def __init__(self):
+        pass
 
     async def execute(self, prompt: str) -> BytesIO | None:
         print(f"Executing model: {self.meta.version} via Gradio space: {self.gradio_space_id}")
         try:
-            client = Client(
-                self.gradio_space_id,
-                download_files=False
-            )
-
-            predict_args = self.default_predict_params.copy()
-            predict_args['prompt'] = prompt
-
-            if 'api_name' not in predict_args:
-                raise ValueError(f"Missing 'api_name' in default_predict_params for {self.gradio_space_id}")
-
-            print(f"Calling predict with args: {predict_args}")
-            result = client.predict(**predict_args)
-            print(f"Received result from Gradio: {result}")
-            result = result[0]
-
-            image_url = self._parse_gradio_result(result)
-            if not image_url:
-                raise ValueError(f"Could not extract image URL/path from Gradio result: {result}")
-
-            return self._process_result(image_url)
+            return await self._generate(prompt)
 
         except gradio_client.exceptions.AppError as e:
             print(f"Gradio AppError for {self.gradio_space_id}: {e}. Trying backup...")
@@ -65,10 +55,28 @@ class FluxGradioBaseModel(TextToImgModel):
             except Exception as backup_e:
                 print(f"Backup mechanism failed for {self.meta.version}: {backup_e}")
                 return None
-        except (requests.exceptions.RequestException, ValueError, Exception) as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, Exception) as e:
             print(f"Error during execution or processing for {self.meta.version}: {e}")
             return None
 
+    async def _generate(self, prompt: str) -> BytesIO:
+        predict_args = self.default_predict_params.copy()
+        predict_args['prompt'] = prompt
+
+        if 'api_name' not in predict_args:
+            raise ValueError(f"Missing 'api_name' in default_predict_params for {self.gradio_space_id}")
+
+        print(f"Calling predict with args: {predict_args}")
+        result = await GradioClientPool().predict(self.gradio_space_id, **predict_args)
+        print(f"Received result from Gradio: {result}")
+        result = result[0]
+
+        image_url = self._parse_gradio_result(result)
+        if not image_url:
+            raise ValueError(f"Could not extract image URL/path from Gradio result: {result}")
+
+        return await self._process_result(image_url)
+
     @staticmethod
     def _parse_gradio_result(result: Any) -> Union[str, None]:
         if isinstance(result, list) and len(result) > 0:
@@ -84,18 +92,14 @@ class FluxGradioBaseModel(TextToImgModel):
         return None
 
     @staticmethod
-    def _process_result(image_url):
+    async def _process_result(image_url):
         print(f"Downloading image from: {image_url}")
         try:
             if not image_url.startswith(('http://', 'https://')):
                 raise ValueError(f"Received path instead of URL: {image_url}. Cannot download directly.")
 
-            response = requests.get(image_url, stream=True, timeout=60)
-            response.raise_for_status()
-            image_data = io.BytesIO(response.content)
-            image_data.seek(0)
-            return image_data
-        except requests.exceptions.RequestException as e:
+            return await download_bytes(image_url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"Failed to download image from {image_url}: {e}")
             raise
         except ValueError as e:
@@ -108,37 +112,119 @@ class FluxGradioBaseModel(TextToImgModel):
 
 @register_model()
 class FluxSchnellModel(FluxGradioBaseModel):
-    def __init__(self):
-        default_params = {
-            "seed": 0,
-            "randomize_seed": True,
-            "width": 1024,
-            "height": 1024,
-            "num_inference_steps": 4,
-            "api_name": "/infer"
-        }
-        super().__init__(
-            gradio_space_id="black-forest-labs/FLUX.1-schnell",
-            model_version="FLUX.1-schnell",
-            description="быстрая модель FLUX.1-schnell для генерации картинок",
-            default_predict_params=default_params
+    meta = ModelInfo(
+        provider=FluxGradioBaseModel.provider,
+        version="FLUX.1-schnell",
+        description="быстрая модель FLUX.1-schnell для генерации картинок (Запросы только на английском).",
+        capabilities=(TextToImgModel,),
+        is_async=False,
+        timeout=120
+    )
+    gradio_space_id = "black-forest-labs/FLUX.1-schnell"
+    default_predict_params = {
+        "seed": 0,
+        "randomize_seed": True,
+        "width": 1024,
+        "height": 1024,
+        "num_inference_steps": 4,
+        "api_name": "/infer"
+    }
+    backup_gradio_space_id = "lalashechka/FLUX_1"
+    backup_api_name = "/predict"
+
+    async def execute(self, prompt: str) -> BytesIO | None:
+        if not FLUX_HEDGE_ENABLED:
+            return await super().execute(prompt)
+
+        print(f"Executing model: {self.meta.version} via Gradio space: {self.gradio_space_id} (hedged)")
+        primary = asyncio.create_task(self._timed_attempt(self.gradio_space_id, self._generate, prompt))
+        backup = None
+        pending = {primary}
+        try:
+            delay = self.hedge_delay()
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            controller = get_admission_controller(self.meta.provider, self.meta.model_id)
+            # Хедж - вторая задача в Gradio, поэтому занимает свое место у провайдера; если мест нет,
+            # запрос продолжает ждать основной Space, не увеличивая нагрузку.
+            if not done and await controller.try_acquire():
+                print(f"Primary space {self.gradio_space_id} did not answer in {delay:.1f}s, "
+                      f"firing backup {self.backup_gradio_space_id}")
+                backup = asyncio.create_task(
+                    self._timed_attempt(self.backup_gradio_space_id, self._generate_backup, prompt)
+                )
+                backup.add_done_callback(lambda _: controller.release())
+                pending.add(backup)
+            elif not done:
+                print(f"Primary space {self.gradio_space_id} is slow, but provider {self.meta.provider} "
+                      f"has no free slot for a hedge")
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result is not None:
+                        return result
+                if backup is None:
+                    # Основной Space упал раньше порога - резерв запускается сразу, как и до хеджирования.
+                    print(f"Primary space {self.gradio_space_id} failed, trying backup...")
+                    backup = asyncio.create_task(
+                        self._timed_attempt(self.backup_gradio_space_id, self._generate_backup, prompt)
+                    )
+                    pending.add(backup)
+            return None
+        finally:
+            for task in (primary, backup):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def hedge_delay(self) -> float:
+        histogram = get_latency_histogram(self.gradio_space_id)
+        threshold = histogram.percentile(FLUX_HEDGE_QUANTILE)
+        if threshold is None or histogram.sample_size() < FLUX_HEDGE_MIN_SAMPLES:
+            return FLUX_HEDGE_DEFAULT_DELAY
+        return min(FLUX_HEDGE_MAX_DELAY, max(FLUX_HEDGE_MIN_DELAY, threshold))
+
+    @staticmethod
+    async def _timed_attempt(space_id: str, generate: Callable[[str], Awaitable[BytesIO]],
+                             prompt: str) -> Optional[BytesIO]:
+        started_at = time.monotonic()
+        histogram = get_latency_histogram(space_id)
+        try:
+            result = await generate(prompt)
+        except asyncio.CancelledError:
+            # Отмененный медленный Space тоже учитывается (как оценка снизу), иначе p95 занижается
+            # и порог хеджирования сползает к FLUX_HEDGE_MIN_DELAY.
+            histogram.observe(time.monotonic() - started_at, censored=True)
+            print(f"Request to {space_id} cancelled: another space answered first")
+            raise
+        except Exception as e:
+            histogram.observe(time.monotonic() - started_at, censored=True)
+            print(f"Error during execution for space {space_id}: {e}")
+            return None
+        histogram.observe(time.monotonic() - started_at)
+        return result
+
+    async def _generate_backup(self, prompt: str) -> BytesIO:
+        result = await GradioClientPool().predict(
+            self.backup_gradio_space_id,
+            prompt=prompt,
         )
-        self.backup_gradio_space_id = "lalashechka/FLUX_1"
-        self.backup_api_name = "/predict"
+        image_url = self._parse_gradio_result(result)
+        if not image_url:
+            raise ValueError(f"Could not extract image URL/path from backup Gradio result: {result}")
+
+        return await self._process_result(image_url)
 
     async def _use_backup(self, prompt: str) -> BytesIO | None:
         print(f"Using backup space: {self.backup_gradio_space_id}")
         try:
-            backup_client = Client(self.backup_gradio_space_id, download_files=False)
-            result = backup_client.predict(
-                prompt=prompt,
-            )
-            image_url = self._parse_gradio_result(result)
-            if not image_url:
-                print(f"Could not extract image URL/path from backup Gradio result: {result}")
-                return None
-
-            return self._process_result(image_url)
+            return await self._generate_backup(prompt)
         except Exception as e:
             print(f"Error during backup execution for {self.backup_gradio_space_id}: {e}")
             return None
+
+
+# Регистрация Spaces в пуле не открывает соединений, клиенты создаются при первом запросе.
+GradioClientPool().register_space(FluxSchnellModel.gradio_space_id, FluxGradioBaseModel.provider, download_files=False)
+GradioClientPool().register_space(FluxSchnellModel.backup_gradio_space_id, FluxGradioBaseModel.provider,
+                                  download_files=False)
@@ -1,31 +1,39 @@
 import os
 from io import BytesIO
-from typing import Union
-from google.genai import types
+from typing import Union, AsyncIterator
+from google.genai import types, errors
 from google import genai
 from registry import (TextToTextModel, TextToImgModel,
                       ImgToTextModel, AudioToTextModel,
-                      register_model, ModelInfo, BaseAIModel)
+                      register_model, ModelInfo, BaseAIModel, DEFAULT_CACHE_TTL)
+from utils.rate_limit import get_admission_controller
 
 
 class GeminiBaseModel(BaseAIModel):
     provider = "Gemini"
-    client = None
-
-    def __init__(self, model_version: str, description: str, capabilities: tuple):
-        if not GeminiBaseModel.client:
-            GeminiBaseModel.client = genai.Client(api_key=os.environ["GEMINI_APIKEY"])
-
-        self.meta = ModelInfo(
-            provider=self.provider,
-            version=model_version,
-            description=description,
-            capabilities=capabilities,
-            is_async=False
-        )
+    _client = None
+
+    def __init__(self):
+        pass
+
+    @property
+    def client(self) -> genai.Client:
+        # Клиент создается при первом запросе, а не при импорте модуля.
+        if not GeminiBaseModel._client:
+            GeminiBaseModel._client = genai.Client(api_key=os.environ["GEMINI_APIKEY"])
+        return GeminiBaseModel._client
 
     async def execute(self, input_data: Union[str, BytesIO], prompt: str = None, enforce_text_response: bool = False) -> \
             Union[str, BytesIO, None]:
+        try:
+            return await self._dispatch(input_data, prompt, enforce_text_response)
+        except errors.APIError as e:
+            if self._check_rate_limit(e):
+                return None
+            raise
+
+    async def _dispatch(self, input_data: Union[str, BytesIO], prompt: str, enforce_text_response: bool) -> \
+            Union[str, BytesIO, None]:
         if isinstance(input_data, str):
             if TextToImgModel in self.meta.capabilities and not enforce_text_response:
                 return await self._generate_content(prompt=input_data, modalities=['Image', 'Text'])
@@ -41,15 +49,36 @@ class GeminiBaseModel(BaseAIModel):
         return None
 
     async def _generate_text(self, prompt: str) -> str:
-        response = self.client.models.generate_content(
+        response = await self.client.aio.models.generate_content(
             model=self.meta.version,
             contents=prompt
         )
         return response.text
 
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        try:
+            async for chunk in await self.client.aio.models.generate_content_stream(
+                    model=self.meta.version,
+                    contents=prompt
+            ):
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            # Ошибка пробрасывается, чтобы оборванный ответ не выглядел полным.
+            self._check_rate_limit(e)
+            print(f"Error in text streaming: {str(e)}")
+            raise
+
+    def _check_rate_limit(self, error: Exception) -> bool:
+        if isinstance(error, errors.APIError) and error.code == 429:
+            print(f"Gemini rate limit for {self.meta.version}: {error}")
+            get_admission_controller(self.meta.provider, self.meta.model_id).penalize()
+            return True
+        return False
+
     async def _generate_content(self, prompt: str, modalities: list) -> Union[BytesIO, str, None]:
         try:
-            response = self.client.models.generate_content(
+            response = await self.client.aio.models.generate_content(
                 model=self.meta.version,
                 contents=prompt,
                 config=types.GenerateContentConfig(
@@ -65,6 +94,7 @@ class GeminiBaseModel(BaseAIModel):
             return self._parse_response(content)
 
         except Exception as e:
+            self._check_rate_limit(e)
             print(f"Error in content generation: {str(e)}")
             return None
 
@@ -86,7 +116,7 @@ class GeminiBaseModel(BaseAIModel):
             mime_type="image/jpeg",
             data=image.getvalue()
         ))
-        response = self.client.models.generate_content(
+        response = await self.client.aio.models.generate_content(
             model=self.meta.version,
             contents=[image_part, prompt]
         )
@@ -97,7 +127,7 @@ class GeminiBaseModel(BaseAIModel):
             mime_type="audio/mpeg",
             data=audio.getvalue()
         ))
-        response = self.client.models.generate_content(
+        response = await self.client.aio.models.generate_content(
             model=self.meta.version,
             contents=[audio_part]
         )
@@ -106,54 +136,68 @@ class GeminiBaseModel(BaseAIModel):
 
 @register_model()
 class GeminiFlash(GeminiBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="gemini-2.0-flash-exp-image-generation",
-            description="быстро работающая модель, поддерживающая генерацию картинок",
-            capabilities=(
-                TextToTextModel,
-                TextToImgModel,
-                ImgToTextModel,
-                AudioToTextModel
-            )
-        )
+    meta = ModelInfo(
+        provider=GeminiBaseModel.provider,
+        version="gemini-2.0-flash-exp-image-generation",
+        description="быстро работающая модель, поддерживающая генерацию картинок",
+        capabilities=(
+            TextToTextModel,
+            TextToImgModel,
+            ImgToTextModel,
+            AudioToTextModel
+        ),
+        is_async=True,
+        cache_ttl=DEFAULT_CACHE_TTL
+    )
 
 
 @register_model()
 class GeminiPro(GeminiBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="gemini-1.5-pro",
-            description="продвинутая модель gemini, способная к более точному анализу",
-            capabilities=(TextToTextModel,)
-        )
+    meta = ModelInfo(
+        provider=GeminiBaseModel.provider,
+        version="gemini-1.5-pro",
+        description="продвинутая модель gemini, способная к более точному анализу",
+        capabilities=(TextToTextModel,),
+        is_async=True,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
 
 
 @register_model()
 class GeminiFlashLite(GeminiBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="gemini-2.0-flash-lite",
-            description="облегченная и быстрая модель Gemini, оптимизированная для скорости и эффективности.",
-            capabilities=(TextToTextModel, ImgToTextModel, AudioToTextModel,)
-        )
+    meta = ModelInfo(
+        provider=GeminiBaseModel.provider,
+        version="gemini-2.0-flash-lite",
+        description="облегченная и быстрая модель Gemini, оптимизированная для скорости и эффективности.",
+        capabilities=(TextToTextModel, ImgToTextModel, AudioToTextModel,),
+        is_async=True,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
 
 
 @register_model()
 class GeminiFlashOld(GeminiBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="gemini-1.5-flash",
-            description="более ранняя версия Gemini Flash, с балансом скорости и возможностей.",
-            capabilities=(TextToTextModel, ImgToTextModel, AudioToTextModel)
-        )
+    meta = ModelInfo(
+        provider=GeminiBaseModel.provider,
+        version="gemini-1.5-flash",
+        description="более ранняя версия Gemini Flash, с балансом скорости и возможностей.",
+        capabilities=(TextToTextModel, ImgToTextModel, AudioToTextModel),
+        is_async=True,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
 
 
 @register_model()
 class GeminiFlashOldLite(GeminiBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="gemini-1.5-flash-8b",
-            description="самая легкая и старая Gemini Flash для задач с ограниченными ресурсами.",
-            capabilities=(TextToTextModel, ImgToTextModel, AudioToTextModel)
-        )
+    meta = ModelInfo(
+        provider=GeminiBaseModel.provider,
+        version="gemini-1.5-flash-8b",
+        description="самая легкая и старая Gemini Flash для задач с ограниченными ресурсами.",
+        capabilities=(TextToTextModel, ImgToTextModel, AudioToTextModel),
+        is_async=True,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
@@ -1,69 +1,114 @@
-from groq import Groq
+from groq import AsyncGroq, RateLimitError
 import os
-from registry import TextToTextModel, register_model, ModelInfo, BaseAIModel
+from typing import AsyncIterator
+from registry import TextToTextModel, register_model, ModelInfo, BaseAIModel, DEFAULT_CACHE_TTL
+from utils.rate_limit import get_admission_controller
 
 
 class LlamaBaseModel(BaseAIModel):
     provider = "Llama"
-    client = None
+    _client = None
 
-    def __init__(self, model_version: str, description: str):
-        if not LlamaBaseModel.client:
-            LlamaBaseModel.client = Groq(api_key=os.environ["GROQ_APIKEY"])
+    def __init__(self):
+        pass
 
-        self.meta = ModelInfo(
-            provider=self.provider,
-            version=model_version,
-            description=description,
-            capabilities=(TextToTextModel,),
-            is_async=False
-        )
+    @property
+    def client(self) -> AsyncGroq:
+        # Клиент создается при первом запросе, а не при импорте модуля.
+        if not LlamaBaseModel._client:
+            LlamaBaseModel._client = AsyncGroq(api_key=os.environ["GROQ_APIKEY"])
+        return LlamaBaseModel._client
 
     async def execute(self, prompt: str) -> str | None:
         try:
-            completion = self.client.chat.completions.create(
+            completion = await self.client.chat.completions.create(
                 model=self.meta.version,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=1,
                 max_tokens=1024
             )
             return completion.choices[0].message.content
+        except RateLimitError as e:
+            self._on_rate_limit(e)
+            return None
         except Exception as e:
             print(e)
             return None
 
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        try:
+            completion = await self.client.chat.completions.create(
+                model=self.meta.version,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=1,
+                max_tokens=1024,
+                stream=True
+            )
+            async for chunk in completion:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        except RateLimitError as e:
+            # Ошибка пробрасывается, чтобы оборванный ответ не выглядел полным.
+            self._on_rate_limit(e)
+            raise
+
+    def _on_rate_limit(self, error: RateLimitError) -> None:
+        print(f"Groq rate limit for {self.meta.version}: {error}")
+        get_admission_controller(self.meta.provider, self.meta.model_id).penalize(error.response.headers.get("retry-after"))
+
 
 @register_model()
 class Llama3_1_8B(LlamaBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="llama-3.1-8b-instant",
-            description="быстрая 8B модель Llama 3.1 с низкой задержкой"
-        )
+    meta = ModelInfo(
+        provider=LlamaBaseModel.provider,
+        version="llama-3.1-8b-instant",
+        description="быстрая 8B модель Llama 3.1 с низкой задержкой",
+        capabilities=(TextToTextModel,),
+        is_async=True,
+        timeout=30,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
 
 
 @register_model()
 class Llama3_1_70B_versatile(LlamaBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="llama-3.3-70b-versatile",
-            description="мощная и универсальная 70B модель Llama"
-        )
+    meta = ModelInfo(
+        provider=LlamaBaseModel.provider,
+        version="llama-3.3-70b-versatile",
+        description="мощная и универсальная 70B модель Llama",
+        capabilities=(TextToTextModel,),
+        is_async=True,
+        timeout=30,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
 
 
 @register_model()
 class Llama3_8B_8192(LlamaBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="llama3-8b-8192",
-            description="быстрая 8B модель Llama 3 с контекстным окном 8192 токенов"
-        )
+    meta = ModelInfo(
+        provider=LlamaBaseModel.provider,
+        version="llama3-8b-8192",
+        description="быстрая 8B модель Llama 3 с контекстным окном 8192 токенов",
+        capabilities=(TextToTextModel,),
+        is_async=True,
+        timeout=30,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
 
 
 @register_model()
 class Llama3_70B_8192(LlamaBaseModel):
-    def __init__(self):
-        super().__init__(
-            model_version="llama3-70b-8192",
-            description="мощная 70B модель Llama 3 с контекстным окном 8192 токенов"
-        )
+    meta = ModelInfo(
+        provider=LlamaBaseModel.provider,
+        version="llama3-70b-8192",
+        description="мощная 70B модель Llama 3 с контекстным окном 8192 токенов",
+        capabilities=(TextToTextModel,),
+        is_async=True,
+        timeout=30,
+        cache_ttl=DEFAULT_CACHE_TTL,
+        supports_streaming=True
+    )
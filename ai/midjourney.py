@@ -1,22 +1,28 @@
 import io
-import requests
+import asyncio
+import aiohttp
 import gradio_client.exceptions
 
 from abc import ABC
-from gradio_client import Client
 from registry import register_model, TextToImgModel, ModelInfo
+from utils.gradio_pool import GradioClientPool
+from utils.http import download_bytes
+
+MIDJOURNEY_SPACE_ID = "mukaist/Midjourney"
 
 
 @register_model()
 class MidjourneyModel(TextToImgModel, ABC):
+    meta = ModelInfo(
+        provider="MidJourney",
+        version="Midjourney",
+        description="модель для генерации изображений по текстовому (только английский) описанию.",
+        capabilities=(TextToImgModel,),
+        is_async=False,
+        timeout=120
+    )
+
     def __init__(self):
-        self.meta = ModelInfo(
-            provider="MidJourney",
-            version="Midjourney",
-            description="модель для генерации изображений по текстовому (только английский) описанию.",
-            capabilities=(TextToImgModel,),
-            is_async=False
-        )
         self.negative_prompt = (
             "(deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon,"
             "drawing, anime:1.4), text, close up, cropped, out of frame, worst quality, low quality,"
@@ -28,11 +34,8 @@ class MidjourneyModel(TextToImgModel, ABC):
 
     async def execute(self, prompt: str) -> io.BytesIO | None:
         try:
-            client = Client(
-                "mukaist/Midjourney",
-                download_files=False
-            )
-            result = client.predict(
+            result = await GradioClientPool().predict(
+                MIDJOURNEY_SPACE_ID,
                 prompt=prompt,
                 negative_prompt=self.negative_prompt,
                 use_negative_prompt=True,
@@ -49,12 +52,12 @@ class MidjourneyModel(TextToImgModel, ABC):
                 raise RuntimeError(f"Неожиданный результат от Gradio space: {result}")
 
             image_url = result['image']['url']
-            return self._process_result(image_url)
+            return await self._process_result(image_url)
 
         except gradio_client.exceptions.AppError as e:
             print(e)
             return None
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(e)
             return None
         except Exception as e:
@@ -62,13 +65,12 @@ class MidjourneyModel(TextToImgModel, ABC):
             return None
 
     @staticmethod
-    def _process_result(image_url):
+    async def _process_result(image_url):
         try:
-            response = requests.get(image_url, stream=True, timeout=60)
-            response.raise_for_status()
-            image_data = io.BytesIO(response.content)
-            image_data.seek(0)
-            return image_data
-        except requests.exceptions.RequestException as e:
+            return await download_bytes(image_url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print({e})
             raise
+
+
+GradioClientPool().register_space(MIDJOURNEY_SPACE_ID, MidjourneyModel.meta.provider, download_files=False)
@@ -1,24 +1,32 @@
-from gradio_client import Client, handle_file
+from gradio_client import handle_file
 from registry import AudioToTextModel, register_model, ModelInfo
+from utils.gradio_pool import GradioClientPool
+
+WHISPER_SPACE_ID = "hf-audio/whisper-large-v3"
 
 
 @register_model()
-class WhisperModel:
+class WhisperModel(AudioToTextModel):
+    meta = ModelInfo(
+        provider="whisper",
+        version="whisper-large-v3",
+        description="Audio transcription model",
+        capabilities=(AudioToTextModel,),
+        is_async=False,
+        is_available_to_user=False
+    )
+
     def __init__(self):
-        self.meta = ModelInfo(
-            provider="whisper",
-            version="whisper-large-v3",
-            description="Audio transcription model",
-            capabilities=(AudioToTextModel,),
-            is_async=False,
-            is_available_to_user=False
-        )
-        self.client = Client("hf-audio/whisper-large-v3")
+        pass
 
     async def execute(self, audio_path: str) -> str:
-        result = self.client.predict(
+        result = await GradioClientPool().predict(
+            WHISPER_SPACE_ID,
             inputs=handle_file(audio_path),
             task="transcribe",
             api_name="/predict_1"
         )
         return result
+
+
+GradioClientPool().register_space(WHISPER_SPACE_ID, WhisperModel.meta.provider)
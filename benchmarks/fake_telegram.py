@@ -0,0 +1,238 @@
+"""
+Локальный стенд "поддельного Telegram" для проверки режимов polling и webhook.
+
+Скрипт поднимает HTTP-сервер, который отвечает на методы Bot API (getMe, getUpdates,
+sendMessage, setWebhook и т.д.), и запускает bot.py с TELEGRAM_API_URL, указывающим на него,
+и с отдельной временной БД. Затем от имени разных пользователей отправляется --updates
+команд /start (все сразу или с частотой --rate в секунду): в режиме webhook - POST-запросами
+на вебхук бота (не больше --concurrency одновременно, как max_connections у Telegram),
+в режиме polling - через очередь getUpdates.
+Задержка доставки - время от отправки обновления до первого ответа бота этому пользователю.
+В режиме webhook дополнительно проверяется, что запрос с неверным секретом отклоняется.
+
+Запуск из корня проекта:
+    python benchmarks/fake_telegram.py --mode webhook --updates 500
+    python benchmarks/fake_telegram.py --mode polling --updates 500 --rate 50
+
+С --no-spawn бот не запускается: стенд ждет бота, запущенного вручную с
+TELEGRAM_API_URL=http://127.0.0.1:<--api-port> (и WEBHOOK_SECRET, WEBHOOK_PORT в режиме webhook).
+"""
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:fake-telegram-token"
+FIRST_USER_ID = 1_000_000
+
+
+class FakeTelegram:
+    """Минимальная реализация Bot API: запоминает ответы бота и раздает обновления через getUpdates."""
+
+    def __init__(self):
+        self.updates = []
+        self.new_updates = asyncio.Condition()
+        self.sent_at = {}
+        self.replied_at = {}
+        self.polled = asyncio.Event()
+        self.calls = {}
+        self._message_id = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0)))
+        elif method.startswith(("send", "edit")):
+            chat_id = int(params["chat_id"])
+            self.replied_at.setdefault(chat_id, time.perf_counter())
+            self._message_id += 1
+            result = {"message_id": self._message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, offset: int, timeout: float):
+        self.polled.set()
+        async with self.new_updates:
+            if not any(update["update_id"] >= offset for update in self.updates):
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        return [update for update in self.updates if update["update_id"] >= offset]
+
+    async def enqueue(self, update: dict) -> None:
+        async with self.new_updates:
+            self.updates.append(update)
+            self.new_updates.notify_all()
+
+
+def start_update(number: int) -> dict:
+    user_id = FIRST_USER_ID + number
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{number}"}
+    return {
+        "update_id": number + 1,
+        "message": {
+            "message_id": number + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+async def wait_for_bot(args, telegram: FakeTelegram, session: aiohttp.ClientSession, process) -> None:
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"bot.py exited with code {process.returncode}")
+        if args.mode == "polling":
+            if telegram.polled.is_set():
+                return
+        else:
+            try:
+                async with session.get(f"http://127.0.0.1:{args.webhook_port}/healthz") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("bot.py did not start in time")
+
+
+async def post_update(args, session: aiohttp.ClientSession, update: dict, secret: str) -> int:
+    async with session.post(f"http://127.0.0.1:{args.webhook_port}/webhook", json=update,
+                            headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as response:
+        return response.status
+
+
+async def pace(rate: float) -> None:
+    # Без --rate все обновления отправляются сразу, как пик нагрузки.
+    if rate > 0:
+        await asyncio.sleep(1 / rate)
+
+
+async def run(args) -> int:
+    telegram = FakeTelegram()
+    runner = web.AppRunner(telegram.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+
+    process = None
+    db_dir = tempfile.TemporaryDirectory()
+    if not args.no_spawn:
+        env = dict(os.environ, TELEGRAM_BOT_APIKEY=BOT_TOKEN, TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+                   WEBHOOK_SECRET=args.secret, WEBHOOK_BASE_URL="", DATABASE_FILE=os.path.join(db_dir.name, "bot.db"))
+        for key in ("GEMINI_APIKEY", "GROQ_APIKEY", "HF_APIKEY"):
+            env.setdefault(key, "fake-key")
+        subprocess.run([sys.executable, "-c", "import database; database.initialize_database(); "
+                                              "database.close_database()"],
+                       cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        output = None if args.verbose else subprocess.DEVNULL
+        process = subprocess.Popen([sys.executable, "bot.py", "--mode", args.mode, "--port", str(args.webhook_port)],
+                                   cwd=ROOT, env=env, stdout=output, stderr=output)
+
+    failed = False
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await wait_for_bot(args, telegram, session, process)
+
+            if args.mode == "webhook":
+                rejected = start_update(args.updates)
+                status = await post_update(args, session, rejected, args.secret + "-wrong")
+                print(f"Wrong secret token: HTTP {status}")
+                failed |= status != 401
+
+            updates = [start_update(number) for number in range(args.updates)]
+            started_at = time.perf_counter()
+            if args.mode == "webhook":
+                async def deliver(update):
+                    telegram.sent_at[update["message"]["chat"]["id"]] = time.perf_counter()
+                    return await post_update(args, session, update, args.secret)
+
+                deliveries = []
+                for update in updates:
+                    deliveries.append(asyncio.create_task(deliver(update)))
+                    await pace(args.rate)
+                statuses = await asyncio.gather(*deliveries)
+                failed |= any(status != 200 for status in statuses)
+            else:
+                for update in updates:
+                    telegram.sent_at[update["message"]["chat"]["id"]] = time.perf_counter()
+                    await telegram.enqueue(update)
+                    await pace(args.rate)
+
+            deadline = time.monotonic() + args.timeout
+            while (any(chat_id not in telegram.replied_at for chat_id in telegram.sent_at)
+                   and time.monotonic() < deadline):
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started_at
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=args.timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await runner.cleanup()
+        db_dir.cleanup()
+
+    if args.mode == "webhook":
+        rejected_chat = FIRST_USER_ID + args.updates
+        print(f"Update with wrong secret processed: {rejected_chat in telegram.replied_at}")
+        failed |= rejected_chat in telegram.replied_at
+
+    latencies = sorted((telegram.replied_at[chat_id] - sent_at) * 1000
+                       for chat_id, sent_at in telegram.sent_at.items() if chat_id in telegram.replied_at)
+    print(f"{args.mode}: {len(latencies)}/{args.updates} updates answered in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.0f} updates/s)")
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"Delivery latency: median {statistics.median(latencies):.1f} ms, p95 {p95:.1f} ms, "
+              f"max {latencies[-1]:.1f} ms")
+    print(f"Bot API calls: {telegram.calls}")
+    failed |= len(latencies) < args.updates
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="webhook")
+    parser.add_argument("--updates", type=int, default=200, help="Number of /start updates to deliver.")
+    parser.add_argument("--rate", type=float, default=0, help="Updates per second (0 - all at once).")
+    parser.add_argument("--concurrency", type=int, default=40, help="Concurrent webhook requests.")
+    parser.add_argument("--api-port", type=int, default=8081, help="Port of the fake Bot API server.")
+    parser.add_argument("--webhook-port", type=int, default=8080, help="Port of the bot's webhook server.")
+    parser.add_argument("--secret", default="fake-telegram-secret", help="Webhook secret token.")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for all answers.")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="Seconds to wait for the bot to start.")
+    parser.add_argument("--no-spawn", action="store_true", help="Do not start bot.py, use an already running bot.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the output of bot.py.")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Сравнение выбора пар арены: равномерного (random.sample) и адаптивного (utils.matchmaking).
+
+Скрипт моделирует поток голосов: у моделей есть скрытые "истинные" рейтинги, исход каждого
+голоса разыгрывается по модели Bradley–Terry (с долей ничьих). Адаптивный выбор опирается
+на онлайн-рейтинги, которые обновляются так же, как в боте (calculate_elo_update).
+Для каждой стратегии считается, сколько голосов нужно, чтобы порядок моделей стал устойчивым:
+ранговая корреляция Спирмена между рейтингом по накопленным голосам (по умолчанию оценка
+Bradley–Terry, как в recompute_ratings.py) и истинным порядком достигает порога и больше
+не опускается ниже него до конца прогона.
+
+Запуск из корня проекта:
+    python benchmarks/matchmaking_benchmark.py --models 12 --votes 3000 --runs 20
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from utils.matchmaking import MatchCandidate, choose_pair, expected_score
+from utils.ratings import bradley_terry
+from utils.utils import calculate_elo_update
+
+
+def spearman(ranking, truth) -> float:
+    position = {model_id: place for place, model_id in enumerate(truth)}
+    n = len(truth)
+    squared = sum((place - position[model_id]) ** 2 for place, model_id in enumerate(ranking))
+    return 1 - 6 * squared / (n * (n * n - 1))
+
+
+def uniform_pair(candidates, rng):
+    return tuple(rng.sample(candidates, 2))
+
+
+def adaptive_pair(candidates, rng):
+    return choose_pair(candidates, rng=rng)
+
+
+def simulate(strategy, true_ratings, votes, tie_rate, threshold, check_every, estimator, rng) -> int:
+    """Возвращает число голосов до устойчивого порядка (votes + 1, если он не достигнут)."""
+    candidates = [MatchCandidate(model_id) for model_id in true_ratings]
+    index = {candidate.model_id: i for i, candidate in enumerate(candidates)}
+    truth = sorted(true_ratings, key=true_ratings.get, reverse=True)
+    history_a = np.zeros(votes, dtype=np.int32)
+    history_b = np.zeros(votes, dtype=np.int32)
+    history_score = np.zeros(votes)
+    stable_since = None
+
+    for vote in range(1, votes + 1):
+        a, b = strategy(candidates, rng)
+        p = expected_score(true_ratings[a.model_id], true_ratings[b.model_id])
+        roll = rng.random()
+        if roll < tie_rate:
+            score_a = 0.5
+        else:
+            score_a = 1.0 if rng.random() < p else 0.0
+
+        a.rating, b.rating = calculate_elo_update(round(a.rating), round(b.rating), score_a)
+        a.votes += 1
+        b.votes += 1
+        history_a[vote - 1], history_b[vote - 1], history_score[vote - 1] = index[a.model_id], index[b.model_id], score_a
+
+        if vote % check_every == 0:
+            if estimator == "bt":
+                fitted = bradley_terry(history_a[:vote], history_b[:vote], history_score[:vote], len(candidates))
+                estimates = {candidate.model_id: fitted[i] for i, candidate in enumerate(candidates)}
+            else:
+                estimates = {candidate.model_id: candidate.rating for candidate in candidates}
+            ranking = sorted(estimates, key=estimates.get, reverse=True)
+            if spearman(ranking, truth) >= threshold:
+                stable_since = stable_since or vote
+            else:
+                stable_since = None
+
+    return stable_since or votes + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", type=int, default=12, help="Number of simulated models.")
+    parser.add_argument("--spread", type=float, default=600, help="Spread of true ratings (rating points).")
+    parser.add_argument("--votes", type=int, default=3000, help="Votes per simulated run.")
+    parser.add_argument("--runs", type=int, default=20, help="Simulated runs per strategy.")
+    parser.add_argument("--tie-rate", type=float, default=0.1, help="Share of tie votes.")
+    parser.add_argument("--threshold", type=float, default=0.95, help="Spearman correlation of a stable ranking.")
+    parser.add_argument("--check-every", type=int, default=25, help="Votes between ranking checks.")
+    parser.add_argument("--estimator", choices=("bt", "elo"), default="bt",
+                        help="How the ranking is estimated from votes: Bradley-Terry fit or online Elo.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {"uniform": [], "adaptive": []}
+    started_at = time.perf_counter()
+    for run in range(args.runs):
+        world = random.Random(args.seed + run)
+        true_ratings = {f"model-{i}": 1000 + world.uniform(-args.spread / 2, args.spread / 2)
+                        for i in range(args.models)}
+        for name, strategy in (("uniform", uniform_pair), ("adaptive", adaptive_pair)):
+            # У обеих стратегий одинаковые модели и одинаковый генератор исходов.
+            rng = random.Random(args.seed * 1000 + run)
+            results[name].append(simulate(strategy, true_ratings, args.votes, args.tie_rate,
+                                          args.threshold, args.check_every, args.estimator, rng))
+
+    print(f"{args.models} models, {args.runs} runs of {args.votes} votes, {args.estimator} estimator, "
+          f"stable ranking: Spearman >= {args.threshold} until the end of the run "
+          f"({time.perf_counter() - started_at:.1f}s)")
+    for name, needed in results.items():
+        reached = [value for value in needed if value <= args.votes]
+        median = statistics.median(needed)
+        print(f"- {name:8s}: median {median:.0f} votes, mean {statistics.mean(needed):.0f}, "
+              f"reached in {len(reached)}/{len(needed)} runs")
+
+    uniform_median = statistics.median(results["uniform"])
+    adaptive_median = statistics.median(results["adaptive"])
+    print(f"Adaptive matchmaking needs {1 - adaptive_median / uniform_median:.0%} fewer votes (median)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Замер времени запуска бота до вызова start_polling.
+
+Скрипт запускает bot.main() с запрещенными исходящими соединениями: любая попытка
+открыть сокет или разрешить DNS-имя записывается и завершается ошибкой. Запросы
+к Telegram (delete_webhook, start_polling) подменяются заглушками.
+
+Запуск из корня проекта:
+    python benchmarks/startup_benchmark.py
+"""
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+outbound_calls = []
+
+
+def _blocked(name):
+    def wrapper(*args, **kwargs):
+        outbound_calls.append((name, args[:2]))
+        raise ConnectionRefusedError(f"Outbound call blocked by startup benchmark: {name}{args[:2]}")
+
+    return wrapper
+
+
+def main():
+    for key in ("TELEGRAM_BOT_APIKEY", "GEMINI_APIKEY", "GROQ_APIKEY", "HF_APIKEY"):
+        os.environ.setdefault(key, "123456:benchmark-token")
+
+    socket.create_connection = _blocked("socket.create_connection")
+    socket.getaddrinfo = _blocked("socket.getaddrinfo")
+    socket.socket.connect = _blocked("socket.connect")
+    socket.socket.connect_ex = _blocked("socket.connect_ex")
+
+    started_at = time.perf_counter()
+    reached_polling_at = None
+
+    import bot
+    from aiogram import Bot, Dispatcher
+
+    async def fake_delete_webhook(self, *args, **kwargs):
+        return True
+
+    async def fake_start_polling(self, *args, **kwargs):
+        nonlocal reached_polling_at
+        reached_polling_at = time.perf_counter()
+
+    Bot.delete_webhook = fake_delete_webhook
+    Dispatcher.start_polling = fake_start_polling
+
+    asyncio.run(bot.main())
+
+    if reached_polling_at is None:
+        print("start_polling was not reached")
+        sys.exit(1)
+
+    print(f"Reached start_polling in {(reached_polling_at - started_at) * 1000:.1f} ms")
+    print(f"Outbound calls attempted: {len(outbound_calls)}")
+    for name, args in outbound_calls:
+        print(f"  {name}{args}")
+    sys.exit(1 if outbound_calls else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,75 @@
 import handlers.settings_handlers as settings
+import handlers.leaderboard_handlers as leaderboard
 import handlers.single_chat_handlers as single_chat
 import handlers.arena_chat_handlers as arena_chat
+import argparse
 import asyncio
 import os
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.memory import MemoryStorage
 
 
-async def main():
+async def main(mode=None, port=None):
     load_dotenv()
+    # polling - бот сам забирает обновления у Telegram, webhook - Telegram присылает их на HTTP-сервер бота.
+    mode = mode or os.getenv('BOT_MODE', 'polling')
     # Импорт всех моделей и инициализация регистра.
     from ai import gemini, flux, llama, whisper, midjourney
-    from registry import AIRegistry
+    from registry import AIRegistry, shutdown_provider_executors
+    from utils.http import close_http_session
+    from utils.gradio_pool import GradioClientPool
+    from utils.metrics import start_metrics_logging, stop_metrics_logging
+    from database import close_database, close_quota_ledger
+    from utils.fsm_storage import SQLiteStorage
 
     bot_apikey = os.environ["TELEGRAM_BOT_APIKEY"]
-    bot = Bot(token=bot_apikey)
-    dp = Dispatcher()
+    # Адрес Bot API можно подменить, например, на локальный benchmarks/fake_telegram.py.
+    api_url = os.getenv('TELEGRAM_API_URL')
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else None
+    bot = Bot(token=bot_apikey, session=session)
+    # sqlite - состояния пользователей переживают перезапуск бота, memory - хранятся только в памяти.
+    # Хранилище закрывается (и сохраняет изменения) при остановке диспетчера, до закрытия БД.
+    storage = MemoryStorage() if os.getenv('FSM_STORAGE', 'sqlite') == 'memory' else SQLiteStorage()
+    dp = Dispatcher(storage=storage)
 
-    dp.include_routers(settings.router, single_chat.router, arena_chat.router)
+    dp.include_routers(settings.router, leaderboard.router, single_chat.router, arena_chat.router)
 
-    await bot.delete_webhook(drop_pending_updates=False)
-    await dp.start_polling(bot)
+    gradio_pool = GradioClientPool()
+    try:
+        gradio_pool.start_keep_warm()
+        start_metrics_logging()
+        if mode == "webhook":
+            from utils.webhook import run_webhook, WEBHOOK_PORT
+            await run_webhook(dp, bot, os.environ["WEBHOOK_SECRET"], port or WEBHOOK_PORT)
+        else:
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
+    finally:
+        await gradio_pool.stop_keep_warm()
+        await stop_metrics_logging()
+        await close_http_session()
+        shutdown_provider_executors()
+        await close_quota_ledger()
+        close_database()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Run the Telegram bot.")
+    parser.add_argument(
+        "--mode",
+        choices=("polling", "webhook"),
+        default=None,
+        help="How updates are received (BOT_MODE from the environment or polling by default)."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="Port of the webhook server (WEBHOOK_PORT from the environment or 8080 by default)."
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.mode, args.port))
@@ -1,33 +1,158 @@
+import asyncio
 import sqlite3
 import os
-from functools import wraps
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import wraps, partial
 
 from aiogram import types
 from aiogram.exceptions import TelegramAPIError
 from dotenv import load_dotenv
-from typing import Optional, List, Tuple, Dict
+from typing import Optional, List, Tuple, Dict, Callable, Any
+
+from utils.utils import calculate_elo_update
 
 load_dotenv()
 DATABASE_FILE = os.getenv('DATABASE_FILE', 'bot_data.db')
 DEFAULT_DAILY_QUOTA = int(os.getenv('DEFAULT_DAILY_QUOTA', '20'))
+DB_READER_POOL_SIZE = int(os.getenv('DB_READER_POOL_SIZE', '4'))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+# Квоты хранятся в памяти и записываются в БД пачками: не реже раза в QUOTA_FLUSH_INTERVAL секунд
+# и сразу, как только накопится QUOTA_MAX_UNFLUSHED единиц изменений.
+QUOTA_FLUSH_INTERVAL = float(os.getenv('QUOTA_FLUSH_INTERVAL', '5'))
+QUOTA_MAX_UNFLUSHED = int(os.getenv('QUOTA_MAX_UNFLUSHED', '50'))
+QUOTA_LEDGER_IDLE_TTL = float(os.getenv('QUOTA_LEDGER_IDLE_TTL', '600'))
+# memory - квоты в памяти процесса (один экземпляр бота); db - каждое списание атомарно проверяется
+# и записывается в общей БД, обязательно, если с одной БД работают несколько экземпляров.
+QUOTA_MODE = os.getenv('QUOTA_MODE', 'memory')
+# Таблица лидеров читается из БД не чаще раза в LEADERBOARD_REFRESH_INTERVAL секунд,
+# между обновлениями в ней отражаются голоса, поданные в этом процессе.
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv('LEADERBOARD_REFRESH_INTERVAL', '60'))
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))
+
+# Рейтинги ведутся отдельно для каждого вида арены: текст, изображения, фото и голос на входе.
+ARENA_TYPES = ("text", "image", "photo", "voice")
+
+
+class DatabaseManager:
+    """
+    Долгоживущие соединения с SQLite: одно соединение для записи, с которым работает
+    отдельный поток, и по соединению на каждый поток пула чтения. В режиме WAL чтение
+    не ждет записи, а обработчики не блокируют event loop, ожидая БД в потоках.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._writer_executor = None
+            cls._instance._reader_executor = None
+            cls._instance._writer_conn = None
+            cls._instance._reader_conns = []
+            cls._instance._local = threading.local()
+            cls._instance._lock = threading.Lock()
+        return cls._instance
+
+    @staticmethod
+    def _connect() -> sqlite3.Connection:
+        conn = sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        # В режиме WAL synchronous=NORMAL не портит БД при сбое, теряются только последние транзакции.
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _get_writer_connection(self) -> sqlite3.Connection:
+        # Вызывается только из потока записи.
+        if self._writer_conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA journal_mode = WAL")
+            self._writer_conn = conn
+        return self._writer_conn
+
+    def _get_reader_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _get_writer_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._writer_executor is None:
+                self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+            return self._writer_executor
+
+    def _get_reader_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._reader_executor is None:
+                self._reader_executor = ThreadPoolExecutor(max_workers=DB_READER_POOL_SIZE,
+                                                           thread_name_prefix="db-reader")
+            return self._reader_executor
+
+    def _run_write(self, func: Callable, *args):
+        conn = self._get_writer_connection()
+        with conn:
+            return func(conn, *args)
 
+    def _run_read(self, func: Callable, *args):
+        return func(self._get_reader_connection(), *args)
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_FILE)
-    return conn
+    def write_sync(self, func: Callable, *args):
+        """Выполняет func(conn, *args) в одной транзакции в потоке записи и ждет результата."""
+        return self._get_writer_executor().submit(self._run_write, func, *args).result()
 
+    def read_sync(self, func: Callable, *args):
+        return self._get_reader_executor().submit(self._run_read, func, *args).result()
 
-def initialize_database():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
+    async def write(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_writer_executor(), partial(self._run_write, func, *args))
+
+    async def read(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_reader_executor(), partial(self._run_read, func, *args))
+
+    def close(self) -> None:
+        with self._lock:
+            executors = (self._writer_executor, self._reader_executor)
+            self._writer_executor = None
+            self._reader_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        with self._lock:
+            conns = self._reader_conns
+            self._reader_conns = []
+            self._local = threading.local()
+        if self._writer_conn is not None:
+            conns.append(self._writer_conn)
+            self._writer_conn = None
+        for conn in conns:
+            conn.close()
+        print("Database connections closed")
+
+
+def close_database() -> None:
+    DatabaseManager().close()
+
+
+def _create_tables(conn: sqlite3.Connection):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS ai_models (
             model_id TEXT PRIMARY KEY,
             display_name TEXT NOT NULL,
             rating INTEGER NOT NULL DEFAULT 1000
         )
     """)
-    cursor.execute(f"""
+    conn.execute(f"""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             quota_limit INTEGER NOT NULL DEFAULT {DEFAULT_DAILY_QUOTA},
@@ -35,185 +160,556 @@ def initialize_database():
             last_reset_date TEXT NOT NULL DEFAULT (date('now'))
         )
     """, )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS votes (
+            vote_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model_a TEXT NOT NULL,
+            model_b TEXT NOT NULL,
+            outcome TEXT NOT NULL CHECK (outcome IN ('a', 'b', 'tie')),
+            arena_type TEXT,
+            user_id INTEGER,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_votes_arena_type ON votes (arena_type)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS model_ratings (
+            model_id TEXT NOT NULL,
+            arena_type TEXT NOT NULL,
+            rating INTEGER NOT NULL DEFAULT 1000,
+            votes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (model_id, arena_type)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_model_ratings_arena_rating ON model_ratings (arena_type, rating DESC)")
+    _create_fsm_states_table(conn)
+
+
+def _create_fsm_states_table(conn: sqlite3.Connection):
+    # Состояния FSM пользователей (utils.fsm_storage.SQLiteStorage), data - JSON.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)")
+
+
+def initialize_database():
+    DatabaseManager().write_sync(_create_tables)
+    print(f"Database tables 'ai_models', 'users', 'votes', 'model_ratings' and 'fsm_states' ensured in '{DATABASE_FILE}'")
 
-    conn.commit()
-    conn.close()
-    print(f"Database table 'ai_models' ensured in '{DATABASE_FILE}'")
 
+def _insert_model(conn: sqlite3.Connection, model_id: str, display_name: str, initial_rating: int) -> bool:
+    cursor = conn.execute("""
+        INSERT OR IGNORE INTO ai_models (model_id, display_name, rating)
+        VALUES (?, ?, ?)
+    """, (model_id, display_name, initial_rating))
+    return cursor.rowcount > 0
 
-def add_model_if_not_exists(model_id: str, display_name: str, initial_rating: int = 1000):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+
+def add_model_if_not_exists(model_id: str, display_name: str, initial_rating: int = 1000) -> bool:
     try:
-        cursor.execute("""
-            INSERT OR IGNORE INTO ai_models (model_id, display_name, rating)
-            VALUES (?, ?, ?)
-        """, (model_id, display_name, initial_rating))
-        conn.commit()
-        if cursor.rowcount > 0:
+        added = DatabaseManager().write_sync(_insert_model, model_id, display_name, initial_rating)
+        if added:
             print(f"Added model to DB: {model_id}")
-
+        return added
     except sqlite3.Error as e:
         print(f"Database error adding model {model_id}: {e}")
-    finally:
-        conn.close()
+        return False
+
+
+def _select_model_rating(conn: sqlite3.Connection, model_id: str) -> Optional[int]:
+    result = conn.execute("SELECT rating FROM ai_models WHERE model_id = ?", (model_id,)).fetchone()
+    return result[0] if result else None
 
 
-def get_model_rating(model_id: str) -> Optional[int]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
+async def get_model_rating(model_id: str) -> Optional[int]:
     try:
-        cursor.execute("SELECT rating FROM ai_models WHERE model_id = ?", (model_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+        return await DatabaseManager().read(_select_model_rating, model_id)
     except sqlite3.Error as e:
         print(f"Database error getting rating for {model_id}: {e}")
         return None
-    finally:
-        conn.close()
 
 
-def update_model_rating(model_id: str, new_rating: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+VOTE_SCORES = {"a": 1.0, "b": 0.0, "tie": 0.5}
+
+
+def _record_vote(conn: sqlite3.Connection, model_a: str, model_b: str, outcome: str,
+                 arena_type: str, user_id: Optional[int]) -> Tuple[int, int]:
+    conn.execute("""
+        INSERT INTO votes (model_a, model_b, outcome, arena_type, user_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, (model_a, model_b, outcome, arena_type, user_id))
+
+    conn.executemany("INSERT OR IGNORE INTO model_ratings (model_id, arena_type) VALUES (?, ?)",
+                     ((model_a, arena_type), (model_b, arena_type)))
+    arena_ratings = dict(conn.execute("""
+        SELECT model_id, rating FROM model_ratings WHERE arena_type = ? AND model_id IN (?, ?)
+    """, (arena_type, model_a, model_b)).fetchall())
+    new_arena_a, new_arena_b = calculate_elo_update(arena_ratings[model_a], arena_ratings[model_b],
+                                                    VOTE_SCORES[outcome])
+    conn.executemany("UPDATE model_ratings SET rating = ?, votes = votes + 1 WHERE model_id = ? AND arena_type = ?",
+                     ((new_arena_a, model_a, arena_type), (new_arena_b, model_b, arena_type)))
+
+    # Общий рейтинг по всем аренам.
+    ratings = dict(conn.execute("SELECT model_id, rating FROM ai_models WHERE model_id IN (?, ?)",
+                                (model_a, model_b)).fetchall())
+    if model_a in ratings and model_b in ratings:
+        new_rating_a, new_rating_b = calculate_elo_update(ratings[model_a], ratings[model_b], VOTE_SCORES[outcome])
+        conn.executemany("UPDATE ai_models SET rating = ? WHERE model_id = ?",
+                         ((new_rating_a, model_a), (new_rating_b, model_b)))
+    else:
+        print(f"Error: Could not retrieve ratings for one or both models: {model_a}, {model_b}")
+
+    return new_arena_a, new_arena_b
+
+
+async def record_vote(model_a: str, model_b: str, outcome: str, arena_type: str,
+                      user_id: Optional[int] = None) -> Optional[Tuple[int, int]]:
+    """
+    Сохраняет голос арены ('a', 'b' или 'tie') и обновляет рейтинги обеих моделей (в арене и общий)
+    в той же транзакции. Все записи идут через один поток, поэтому одновременные голоса не затирают
+    обновления друг друга. Возвращает новые рейтинги моделей в арене или None при ошибке БД.
+    """
+    if outcome not in VOTE_SCORES:
+        raise ValueError(f"Unexpected vote outcome: {outcome}")
     try:
-        cursor.execute("UPDATE ai_models SET rating = ? WHERE model_id = ?", (new_rating, model_id))
-        conn.commit()
-        if cursor.rowcount == 0:
-            print(f"Warning: Tried to update rating for non-existent model_id: {model_id}")
+        new_ratings = await DatabaseManager().write(_record_vote, model_a, model_b, outcome, arena_type, user_id)
     except sqlite3.Error as e:
-        print(f"Database error updating rating for {model_id}: {e}")
-    finally:
-        conn.close()
+        print(f"Database error recording vote for {model_a} vs {model_b}: {e}")
+        return None
+
+    LeaderboardCache().apply_vote(arena_type, {model_a: new_ratings[0], model_b: new_ratings[1]})
+    return new_ratings
+
+
+@dataclass
+class LeaderboardEntry:
+    model_id: str
+    display_name: str
+    rating: int
+    votes: int
+
+
+def _select_leaderboard(conn: sqlite3.Connection) -> List[Tuple[str, str, str, int, int]]:
+    return conn.execute("""
+        SELECT r.arena_type, r.model_id, COALESCE(m.display_name, r.model_id), r.rating, r.votes
+        FROM model_ratings r
+        LEFT JOIN ai_models m ON m.model_id = r.model_id
+        ORDER BY r.arena_type, r.rating DESC
+    """).fetchall()
+
+
+class LeaderboardCache:
+    """
+    Рейтинги всех арен в памяти. Из БД они перечитываются одним запросом не чаще раза
+    в LEADERBOARD_REFRESH_INTERVAL секунд, сколько бы пользователей ни запрашивали таблицу;
+    голоса, записанные через record_vote, применяются к кэшу сразу.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._entries = {}
+            cls._instance._refreshed_at = None
+            cls._instance._refresh_task = None
+        return cls._instance
+
+    def _is_stale(self) -> bool:
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= LEADERBOARD_REFRESH_INTERVAL
+
+    async def _refresh(self) -> None:
+        try:
+            rows = await DatabaseManager().read(_select_leaderboard)
+            entries = defaultdict(list)
+            for arena_type, model_id, display_name, rating, votes in rows:
+                entries[arena_type].append(LeaderboardEntry(model_id, display_name, rating, votes))
+            self._entries = dict(entries)
+        except sqlite3.Error as e:
+            # Остается прежняя таблица, следующая попытка - через интервал обновления.
+            print(f"Database error refreshing leaderboard: {e}")
+        finally:
+            self._refreshed_at = time.monotonic()
+            self._refresh_task = None
+
+    async def get(self, arena_type: str, limit: Optional[int] = LEADERBOARD_SIZE) -> List[LeaderboardEntry]:
+        if self._is_stale():
+            if self._refresh_task is None:
+                self._refresh_task = asyncio.ensure_future(self._refresh())
+            await asyncio.shield(self._refresh_task)
+        return self._entries.get(arena_type, [])[:limit]
+
+    def apply_vote(self, arena_type: str, ratings: Dict[str, int]) -> None:
+        entries = self._entries.get(arena_type, [])
+        known = {entry.model_id: entry for entry in entries}
+        if any(model_id not in known for model_id in ratings):
+            # Новая для арены модель появится в таблице при следующем чтении из БД.
+            self._refreshed_at = None
+            return
+        for model_id, rating in ratings.items():
+            known[model_id].rating = rating
+            known[model_id].votes += 1
+        entries.sort(key=lambda entry: entry.rating, reverse=True)
+
+
+def _select_votes(conn: sqlite3.Connection, arena_type: Optional[str]) -> List[Tuple[str, str, str]]:
+    query = "SELECT model_a, model_b, outcome FROM votes"
+    params = ()
+    if arena_type:
+        query += " WHERE arena_type = ?"
+        params = (arena_type,)
+    return conn.execute(query + " ORDER BY vote_id", params).fetchall()
+
+
+def get_votes(arena_type: Optional[str] = None) -> List[Tuple[str, str, str]]:
+    try:
+        return DatabaseManager().read_sync(_select_votes, arena_type)
+    except sqlite3.Error as e:
+        print(f"Database error retrieving votes: {e}")
+        return []
+
+
+def _set_model_ratings(conn: sqlite3.Connection, ratings: Dict[str, int], arena_type: Optional[str]) -> int:
+    if arena_type:
+        return conn.executemany("UPDATE model_ratings SET rating = ? WHERE model_id = ? AND arena_type = ?",
+                                [(rating, model_id, arena_type) for model_id, rating in ratings.items()]).rowcount
+    return conn.executemany("UPDATE ai_models SET rating = ? WHERE model_id = ?",
+                            [(rating, model_id) for model_id, rating in ratings.items()]).rowcount
+
+
+def set_model_ratings(ratings: Dict[str, int], arena_type: Optional[str] = None) -> int:
+    """Записывает пересчитанные рейтинги: общие или, если задан arena_type, рейтинги арены."""
+    try:
+        return DatabaseManager().write_sync(_set_model_ratings, ratings, arena_type)
+    except sqlite3.Error as e:
+        print(f"Database error writing recomputed ratings: {e}")
+        return 0
+
+
+def _select_models_sorted_by_rating(conn: sqlite3.Connection, limit: Optional[int]) -> List[Tuple[str, str, int]]:
+    query = "SELECT model_id, display_name, rating FROM ai_models ORDER BY rating DESC"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    return conn.execute(query).fetchall()
 
 
 def get_models_sorted_by_rating(limit: Optional[int] = None) -> List[Tuple[str, str, int]]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        query = "SELECT model_id, display_name, rating FROM ai_models ORDER BY rating DESC"
-        if limit:
-            query += f" LIMIT {int(limit)}"
-        cursor.execute(query)
-        return cursor.fetchall()
+        return DatabaseManager().read_sync(_select_models_sorted_by_rating, limit)
     except sqlite3.Error as e:
         print(f"Database error retrieving sorted models: {e}")
         return []
-    finally:
-        conn.close()
 
 
-def register_or_check_user(user_id: int):
-    conn = get_db_connection()
+async def register_or_check_user(user_id: int):
     try:
-        with conn:
-            _ensure_user_exists_and_reset_quota(user_id, conn)
+        await DatabaseManager().write(_ensure_user_exists, user_id)
     except sqlite3.Error as e:
         print(f"Database error during user check/registration for user {user_id}: {e}")
-    finally:
-        conn.close()
+
+
+def _drop_ai_models_table(conn: sqlite3.Connection):
+    conn.execute("DROP TABLE IF EXISTS ai_models")
 
 
 def drop_ai_models_table():
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("DROP TABLE IF EXISTS ai_models")
-        conn.commit()
+        DatabaseManager().write_sync(_drop_ai_models_table)
         print(f"Table 'ai_models' dropped from '{DATABASE_FILE}'")
     except sqlite3.Error as e:
         print(f"Error dropping table 'ai_models': {e}")
-    finally:
-        conn.close()
 
 
-def _ensure_user_exists_and_reset_quota(user_id: int, conn: sqlite3.Connection):
-    cursor = conn.cursor()
-    cursor.execute("""
+def _ensure_user_exists(conn: sqlite3.Connection, user_id: int):
+    conn.execute("""
         INSERT OR IGNORE INTO users (user_id, quota_limit, quota_used, last_reset_date)
         VALUES (?, ?, 0, date('now'))
     """, (user_id, DEFAULT_DAILY_QUOTA))
-    cursor.execute("""
+
+
+def _reset_stale_quotas(conn: sqlite3.Connection) -> int:
+    return conn.execute("""
         UPDATE users
         SET quota_used = 0, last_reset_date = date('now')
-        WHERE user_id = ? AND last_reset_date != date('now')
-    """, (user_id,))
+        WHERE last_reset_date < date('now')
+    """).rowcount
 
 
-def can_afford_cost(user_id: int, cost: int) -> bool:
-    if cost <= 0:
-        return True
-
-    conn = get_db_connection()
-    can_afford = False
+def compact_user_quotas() -> int:
+    """
+    Обнуляет расход за прошедшие дни одним UPDATE. Для подсчета квоты это не обязательно
+    (устаревший расход и так не учитывается), но удобно запускать раз в сутки, например из cron.
+    """
     try:
-        with conn:
-            _ensure_user_exists_and_reset_quota(user_id, conn)
-            cursor = conn.cursor()
-            cursor.execute("SELECT quota_used, quota_limit FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if result:
-                quota_used, quota_limit = result
-                can_afford = (quota_limit - quota_used) >= cost
-            else:
-                print(f"Error: User {user_id} not found after ensuring existence in can_afford_cost.")
+        compacted = DatabaseManager().write_sync(_reset_stale_quotas)
+        print(f"Reset stale quota usage for {compacted} user(s)")
+        return compacted
     except sqlite3.Error as e:
-        print(f"Database error checking affordability for user {user_id}, cost {cost}: {e}")
-    finally:
-        conn.close()
-    return can_afford
-
-
-def consume_quota(user_id: int, cost: int) -> bool:
-    if cost <= 0:
-        print(f"Attempted to consume non-positive quota cost ({cost}) for user {user_id}. Action skipped.")
-        return True
+        print(f"Database error compacting user quotas: {e}")
+        return 0
+
+
+@dataclass
+class QuotaReservation:
+    """Квота, списанная с пользователя до обработки запроса. Неиспользованная часть возвращается."""
+    user_id: int
+    amount: int
+    limit: int
+    # День, к которому относится списание: после ежедневного сброса возвращать нечего.
+    day: str
+    granted: bool
+
+
+@dataclass
+class _QuotaEntry:
+    limit: int
+    used: int
+    day: str
+    last_access: float
+
+
+def _today() -> str:
+    # Совпадает с date('now') в SQLite (UTC).
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _load_user_quota(conn: sqlite3.Connection, user_id: int) -> Tuple[int, int, str]:
+    # last_reset_date - день, к которому относится quota_used. Расход за прошлые дни
+    # считается нулевым при чтении, поэтому ежедневный сброс не требует записи в БД.
+    result = conn.execute("""
+        SELECT quota_limit, CASE WHEN last_reset_date = date('now') THEN quota_used ELSE 0 END, date('now')
+        FROM users WHERE user_id = ?
+    """, (user_id,)).fetchone()
+    if result is None:
+        # Строка пользователя появится при первой записи расхода.
+        return DEFAULT_DAILY_QUOTA, 0, conn.execute("SELECT date('now')").fetchone()[0]
+    return result
+
+
+def _apply_quota_deltas(conn: sqlite3.Connection, deltas: List[Dict[str, Any]]):
+    # Изменение за прошедший день не применяется, если строка уже относится к следующему.
+    conn.executemany(f"""
+        INSERT INTO users (user_id, quota_limit, quota_used, last_reset_date)
+        VALUES (:user_id, {DEFAULT_DAILY_QUOTA}, MAX(0, :delta), :day)
+        ON CONFLICT(user_id) DO UPDATE
+        SET quota_used = CASE WHEN last_reset_date = :day THEN MAX(0, quota_used + :delta) ELSE MAX(0, :delta) END,
+            last_reset_date = :day
+        WHERE last_reset_date <= :day
+    """, deltas)
+
+
+def _reserve_user_quota(conn: sqlite3.Connection, user_id: int, cost: int) -> Tuple[int, str, bool]:
+    # Проверка остатка и списание - один UPDATE в пишущей транзакции, поэтому экземпляры,
+    # работающие с одной БД, не могут вместе выдать больше дневного лимита.
+    _ensure_user_exists(conn, user_id)
+    granted = conn.execute("""
+        UPDATE users
+        SET quota_used = CASE WHEN last_reset_date = date('now') THEN quota_used ELSE 0 END + :cost,
+            last_reset_date = date('now')
+        WHERE user_id = :user_id
+          AND CASE WHEN last_reset_date = date('now') THEN quota_used ELSE 0 END + :cost <= quota_limit
+    """, {"user_id": user_id, "cost": cost}).rowcount > 0
+    limit, _, day = _load_user_quota(conn, user_id)
+    return limit, day, granted
+
+
+class QuotaLedger:
+    """
+    Квоты активных пользователей в памяти процесса. Резервирование и возврат квоты
+    не обращаются к БД, накопленные изменения записываются в таблицу users одной
+    транзакцией раз в QUOTA_FLUSH_INTERVAL секунд, при накоплении QUOTA_MAX_UNFLUSHED
+    единиц и при остановке бота. При падении процесса теряется не больше этого объема.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._entries = {}
+            cls._instance._loading = {}
+            # Несохраненные изменения quota_used по (user_id, день).
+            cls._instance._pending = defaultdict(int)
+            cls._instance._unflushed = 0
+            cls._instance._flush_task = None
+            cls._instance._flush_requested = None
+            cls._instance._write_task = None
+        return cls._instance
+
+    async def _get_entry(self, user_id: int) -> _QuotaEntry:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            loading = self._loading.get(user_id)
+            if loading is None:
+                loading = asyncio.ensure_future(DatabaseManager().read(_load_user_quota, user_id))
+                self._loading[user_id] = loading
+            try:
+                limit, used, day = await asyncio.shield(loading)
+            finally:
+                self._loading.pop(user_id, None)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = _QuotaEntry(limit, used, day, time.monotonic())
+                self._entries[user_id] = entry
+
+        today = _today()
+        if entry.day != today:
+            entry.day = today
+            entry.used = 0
+        entry.last_access = time.monotonic()
+        return entry
+
+    def _record(self, user_id: int, day: str, delta: int) -> None:
+        self._pending[(user_id, day)] += delta
+        self._unflushed += abs(delta)
+        self._ensure_flusher()
+        if self._unflushed >= QUOTA_MAX_UNFLUSHED:
+            self._flush_requested.set()
+
+    async def reserve(self, user_id: int, cost: int) -> QuotaReservation:
+        entry = await self._get_entry(user_id)
+        granted = entry.limit - entry.used >= cost
+        if granted and cost > 0:
+            entry.used += cost
+            self._record(user_id, entry.day, cost)
+        return QuotaReservation(user_id, cost if granted else 0, entry.limit, entry.day, granted)
+
+    def commit(self, reservation: QuotaReservation, actual_cost: int) -> int:
+        actual_cost = min(max(0, actual_cost), reservation.amount)
+        refund = reservation.amount - actual_cost
+        entry = self._entries.get(reservation.user_id)
+        if refund > 0 and entry is not None and entry.day == reservation.day:
+            entry.used = max(0, entry.used - refund)
+            self._record(reservation.user_id, reservation.day, -refund)
+        return actual_cost
+
+    async def get_info(self, user_id: int) -> Dict[str, int]:
+        entry = await self._get_entry(user_id)
+        return {"limit": entry.limit, "used": entry.used}
+
+    async def _write_deltas(self, deltas: List[Dict[str, Any]]) -> bool:
+        try:
+            await DatabaseManager().write(_apply_quota_deltas, deltas)
+            print(f"Quota ledger flushed {len(deltas)} user(s)")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error flushing quota ledger: {e}")
+            for delta in deltas:
+                self._pending[(delta["user_id"], delta["day"])] += delta["delta"]
+                self._unflushed += abs(delta["delta"])
+            return False
+
+    async def flush(self) -> None:
+        deltas = [{"user_id": user_id, "day": day, "delta": delta}
+                  for (user_id, day), delta in self._pending.items() if delta != 0]
+        self._pending.clear()
+        self._unflushed = 0
+        if deltas:
+            # Отмена flush (например, из stop()) не прерывает запись: пачка расхода не теряется,
+            # а вернуть ее в _pending нельзя - запись в потоке БД может успеть выполниться, и расход
+            # учелся бы дважды. stop() дожидается этой записи.
+            self._write_task = asyncio.ensure_future(self._write_deltas(deltas))
+            if not await asyncio.shield(self._write_task):
+                return
 
-    conn = get_db_connection()
-    consumed = False
+        # Давно неактивные пользователи выгружаются, чтобы изменения лимита в БД подхватывались.
+        expired_before = time.monotonic() - QUOTA_LEDGER_IDLE_TTL
+        pending_users = {user_id for user_id, _ in self._pending}
+        for user_id, entry in list(self._entries.items()):
+            if entry.last_access < expired_before and user_id not in pending_users:
+                del self._entries[user_id]
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=QUOTA_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    def _ensure_flusher(self) -> None:
+        if self._flush_task is None:
+            self._flush_requested = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self._write_task is not None:
+            await self._write_task
+            self._write_task = None
+        await self.flush()
+
+
+async def reserve_quota(user_id: int, cost: int) -> Optional[QuotaReservation]:
+    """
+    Проверяет остаток и списывает cost за один шаг, поэтому одновременные запросы
+    одного пользователя не могут вместе потратить больше лимита.
+    """
     try:
-        with conn:
-            _ensure_user_exists_and_reset_quota(user_id, conn)
-            cursor = conn.cursor()
-            cursor.execute("""
-                 UPDATE users
-                 SET quota_used = quota_used + ?
-                 WHERE user_id = ? AND (quota_limit - quota_used) >= ?
-             """, (cost, user_id, cost))
-            if cursor.rowcount > 0:
-                consumed = True
+        if QUOTA_MODE == "db":
+            limit, day, granted = await DatabaseManager().write(_reserve_user_quota, user_id, cost)
+            return QuotaReservation(user_id, cost if granted else 0, limit, day, granted)
+        return await QuotaLedger().reserve(user_id, cost)
     except sqlite3.Error as e:
-        print(f"Database error consuming quota for user {user_id}, cost {cost}: {e}")
-    finally:
-        conn.close()
+        print(f"Database error reserving quota for user {user_id}, cost {cost}: {e}")
+        return None
+
 
-    if consumed:
-        print(f"Consumed {cost} quota for user {user_id}")
+async def commit_quota(reservation: QuotaReservation, actual_cost: int) -> None:
+    """
+    Оставляет списанными actual_cost (не больше зарезервированного) и возвращает остальное.
+    """
+    if QUOTA_MODE == "db":
+        consumed = max(0, min(actual_cost, reservation.amount))
+        refund = reservation.amount - consumed
+        if refund > 0:
+            try:
+                await DatabaseManager().write(_apply_quota_deltas, [
+                    {"user_id": reservation.user_id, "delta": -refund, "day": reservation.day}
+                ])
+            except sqlite3.Error as e:
+                print(f"Database error refunding {refund} quota for user {reservation.user_id}: {e}")
     else:
-        print(f"Quota limit reached or error for user {user_id} when trying to consume cost {cost}")
+        consumed = QuotaLedger().commit(reservation, actual_cost)
+    if consumed > 0:
+        print(f"Consumed {consumed} quota for user {reservation.user_id}")
 
-    return consumed
 
+async def release_quota(reservation: QuotaReservation) -> None:
+    await commit_quota(reservation, 0)
 
-def get_user_quota_info(user_id: int) -> Optional[Dict[str, int]]:
-    conn = get_db_connection()
-    info = None
+
+async def get_user_quota_info(user_id: int) -> Optional[Dict[str, int]]:
     try:
-        with conn:
-            _ensure_user_exists_and_reset_quota(user_id, conn)
-            cursor = conn.cursor()
-            cursor.execute("SELECT quota_limit, quota_used FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if result:
-                info = {"limit": result[0], "used": result[1]}
+        if QUOTA_MODE == "db":
+            limit, used, _ = await DatabaseManager().read(_load_user_quota, user_id)
+            return {"limit": limit, "used": used}
+        return await QuotaLedger().get_info(user_id)
     except sqlite3.Error as e:
         print(f"Database error getting quota info for user {user_id}: {e}")
-    finally:
-        conn.close()
-    return info
+        return None
+
+
+async def close_quota_ledger() -> None:
+    await QuotaLedger().stop()
 
 
 def quota_check(cost: int):
+    """
+    Резервирует cost единиц квоты до вызова обработчика. Если обработчик вернул int,
+    списывается столько (не больше cost), иначе, как и при исключении, резерв возвращается.
+    """
     if not isinstance(cost, int) or cost < 0:
         raise ValueError("Стоимость квоты должна быть неотрицательным целым числом.")
 
@@ -240,10 +736,10 @@ def quota_check(cost: int):
 
             user_id = user.id
 
-            if not can_afford_cost(user_id, cost):
+            reservation = await reserve_quota(user_id, cost)
+            if reservation is None or not reservation.granted:
                 print(f"Проверка квоты не пройдена для пользователя {user_id}. Требуется: {cost}")
-                quota_info = get_user_quota_info(user_id)
-                limit = quota_info.get('limit', DEFAULT_DAILY_QUOTA) if quota_info else DEFAULT_DAILY_QUOTA
+                limit = reservation.limit if reservation else DEFAULT_DAILY_QUOTA
                 reply_text = f"❌ Ваш дневной лимит запросов ({limit}) исчерпан. Попробуйте завтра."
 
                 try:
@@ -252,8 +748,16 @@ def quota_check(cost: int):
                     print(f"Ошибка отправки сообщения об исчерпании лимита пользователю {user_id}: {e}")
                 return
 
-            print(f"Проверка квоты пройдена для пользователя {user_id}. Требуется: {cost}. Продолжаем.")
-            return await handler(update, *args, **kwargs)
+            print(f"Квота {cost} зарезервирована для пользователя {user_id}. Продолжаем.")
+            consumed = 0
+            try:
+                result = await handler(update, *args, **kwargs)
+                if isinstance(result, int) and not isinstance(result, bool):
+                    consumed = result
+                    return None
+                return result
+            finally:
+                await commit_quota(reservation, consumed)
 
         return wrapper
 
@@ -0,0 +1,357 @@
+import asyncio
+import os
+import time
+from io import BytesIO
+from collections import defaultdict
+from typing import Dict, AsyncIterator, List, Tuple, Type, Optional
+
+from registry import AIRegistry, BaseAIModel, ModelInfo, TextToTextModel, TextToImgModel
+from utils.circuit_breaker import get_breaker
+from utils.deadline import Deadline, ModelTimeoutError
+from utils.progress import JobProgress, ProgressCallback, current_progress_callback, progress_reporter
+from utils.rate_limit import get_admission_controller, estimate_tokens, admission_wait, AdmissionTimeout
+from utils.response_cache import ResponseCache, make_request_key, RESPONSE_CACHE_ENABLED
+
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', '1') == '1'
+# Цепочки резервных моделей: "llama:llama-3.3-70b-versatile=gemini:gemini-2.0-flash-lite,gemini:gemini-1.5-flash;..."
+# Для моделей без явной цепочки резерв подбирается из зарегистрированных моделей с той же возможностью.
+MODEL_FALLBACKS = os.getenv('MODEL_FALLBACKS', '')
+MAX_FALLBACK_ATTEMPTS = int(os.getenv('MAX_FALLBACK_ATTEMPTS', '2'))
+
+# Запросы к провайдерам, которые сейчас выполняются, по ключу запроса (id модели + хэш ввода).
+_in_flight: Dict[str, asyncio.Task] = {}
+# Обработчики, которые ждут каждый из этих запросов: колбэк прогресса каждого (None, если его нет).
+_in_flight_waiters: Dict[str, List[Optional[ProgressCallback]]] = defaultdict(list)
+# Исходы вызовов провайдеров по моделям: ответ, ошибка (в т.ч. пустой ответ) или истекший дедлайн.
+# Выводятся в лог и на /metrics (см. utils/metrics.py).
+_execution_stats = defaultdict(lambda: {"ok": 0, "error": 0, "timeout": 0})
+
+
+def execution_stats() -> Dict[str, Dict[str, int]]:
+    return {model_id: dict(counters) for model_id, counters in _execution_stats.items()}
+
+
+def _copy_response(response):
+    # У каждого ожидающего свой BytesIO, чтобы чтение в одном обработчике не сдвигало позицию в другом.
+    if isinstance(response, BytesIO):
+        return BytesIO(response.getvalue())
+    return response
+
+
+def _parse_fallbacks(raw: str) -> Dict[str, List[str]]:
+    chains = {}
+    for entry in filter(None, (item.strip() for item in raw.split(";"))):
+        model_id, _, fallbacks = entry.partition("=")
+        chains[model_id.strip()] = [fallback.strip() for fallback in fallbacks.split(",") if fallback.strip()]
+    return chains
+
+
+_fallback_chains = _parse_fallbacks(MODEL_FALLBACKS)
+
+
+def _breaker_allows(model: BaseAIModel) -> bool:
+    if get_breaker(model.meta.model_id).allow_request():
+        return True
+    print(f"Circuit for {model.meta.model_id} is open, failing fast")
+    return False
+
+
+async def _run_upstream(model: BaseAIModel, key: str, args, kwargs, deadline: Deadline):
+    model_id = model.meta.model_id
+    breaker = get_breaker(model_id)
+    if breaker.is_open():
+        print(f"Circuit for {model_id} is open, failing fast")
+        return None
+
+    controller = get_admission_controller(model.meta.provider, model.meta.model_id)
+    try:
+        async with controller.admit(estimate_tokens(*args),
+                                   max_wait=admission_wait(model.meta.provider, deadline.remaining())):
+            if not _breaker_allows(model):
+                return None
+
+            started_at = time.monotonic()
+            try:
+                # wait_for отменяет execute() по дедлайну, вместе с ним отменяются и задачи в Gradio Spaces.
+                response = await asyncio.wait_for(model.execute(*args, **kwargs), timeout=deadline.remaining())
+            except asyncio.TimeoutError:
+                breaker.record(False, time.monotonic() - started_at)
+                _execution_stats[model_id]["timeout"] += 1
+                raise ModelTimeoutError(f"{model_id} did not answer within {deadline.timeout:.0f}s")
+            except asyncio.CancelledError:
+                # Отмененный вызов (дедлайн ожидающих, отмена арены) тоже должен дойти до размыкателя,
+                # иначе пробный запрос полуоткрытого размыкателя не завершится никогда.
+                breaker.record(False, time.monotonic() - started_at)
+                raise
+            except Exception:
+                breaker.record(False, time.monotonic() - started_at)
+                _execution_stats[model_id]["error"] += 1
+                raise
+            breaker.record(response is not None, time.monotonic() - started_at)
+            _execution_stats[model_id]["ok" if response is not None else "error"] += 1
+    except AdmissionTimeout as e:
+        print(e)
+        return None
+
+    if response is not None:
+        controller.on_success()
+
+    if RESPONSE_CACHE_ENABLED and model.meta.cache_ttl > 0:
+        await ResponseCache().put(key, response, model.meta.cache_ttl)
+    return response
+
+
+async def _report_to_waiters(waiters: List[Optional[ProgressCallback]], progress: JobProgress) -> None:
+    for callback in list(waiters):
+        if callback is None:
+            continue
+        try:
+            await callback(progress)
+        except Exception as e:
+            print(f"Error reporting job progress: {e}")
+
+
+async def _execute_single_flight(model: BaseAIModel, key: str, args, kwargs, deadline: Deadline):
+    """
+    Одинаковые одновременные запросы к одной модели разделяют один вызов провайдера.
+    Вызов выполняется в отдельной задаче: отмена одного из ожидающих не прерывает его для остальных.
+    Дедлайн запроса соблюдает каждый ожидающий сам, общий вызов ограничен meta.timeout модели
+    и отменяется, когда его больше никто не ждет. Прогресс вызова получают все, кто его еще ждет.
+    """
+    task = _in_flight.get(key)
+    if task is None:
+        # Задача копирует контекст при создании, поэтому вместо колбэка первого ожидающего
+        # ей передается рассылка всем текущим ожидающим.
+        waiters = _in_flight_waiters[key]
+        with progress_reporter(lambda progress: _report_to_waiters(waiters, progress)):
+            task = asyncio.create_task(_run_upstream(model, key, args, kwargs, Deadline(model.meta.timeout)))
+        _in_flight[key] = task
+
+        def forget(finished: asyncio.Task) -> None:
+            if _in_flight.get(key) is finished:
+                del _in_flight[key]
+                _in_flight_waiters.pop(key, None)
+            # Ошибку забирают ожидающие, но если все они ушли по своему дедлайну, ее некому получить.
+            if not finished.cancelled():
+                finished.exception()
+
+        task.add_done_callback(forget)
+    else:
+        print(f"Joined in-flight request to {model.meta.model_id}")
+
+    progress_callback = current_progress_callback()
+    _in_flight_waiters[key].append(progress_callback)
+    try:
+        response = await asyncio.wait_for(asyncio.shield(task), timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        # Дедлайн запроса истекает у ожидающего, поэтому и учитывается здесь; отмененный после этого
+        # общий вызов попадает в окно размыкателя как неудачный.
+        _execution_stats[model.meta.model_id]["timeout"] += 1
+        raise ModelTimeoutError(f"{model.meta.model_id} did not answer within {deadline.timeout:.0f}s")
+    finally:
+        if _in_flight.get(key) is task:
+            _in_flight_waiters[key].remove(progress_callback)
+            if not _in_flight_waiters[key] and not task.done():
+                # Последний ожидающий ушел: вызов провайдера (и задачи в Gradio Spaces) отменяется,
+                # а следующий такой же запрос начнет новый вызов, а не присоединится к отменяемому.
+                del _in_flight[key]
+                _in_flight_waiters.pop(key, None)
+                task.cancel()
+    return _copy_response(response)
+
+
+async def execute_model(model: BaseAIModel, *args, deadline: Optional[Deadline] = None, **kwargs):
+    """
+    Единая точка вызова model.execute() из обработчиков.
+    Если у модели задан meta.cache_ttl, ответ берется из кэша или сохраняется в него.
+    Одинаковые одновременные запросы объединяются в один вызов провайдера; квота при этом
+    списывается декоратором quota_check с каждого пользователя отдельно.
+    Вызов ограничен дедлайном запроса (по умолчанию meta.timeout модели), при его истечении
+    выбрасывается ModelTimeoutError.
+    """
+    if deadline is None:
+        deadline = Deadline(model.meta.timeout)
+    use_cache = RESPONSE_CACHE_ENABLED and model.meta.cache_ttl > 0
+
+    model_id = model.meta.model_id
+    key = make_request_key(model_id, args, kwargs)
+
+    if use_cache:
+        cached = await ResponseCache().get(model_id, key)
+        if cached is not None:
+            print(f"Response cache hit for {model_id}")
+            return cached
+
+    if SINGLE_FLIGHT_ENABLED:
+        return await _execute_single_flight(model, key, args, kwargs, deadline)
+
+    response = await _run_upstream(model, key, args, kwargs, deadline)
+    if isinstance(response, BytesIO):
+        response.seek(0)
+    return response
+
+
+async def stream_model(model: BaseAIModel, prompt: str, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    """
+    Потоковый вариант execute_model для текстовых моделей с meta.supports_streaming.
+    Ответ из кэша отдается одним куском, полностью полученный поток сохраняется в кэш.
+    """
+    if deadline is None:
+        deadline = Deadline(model.meta.timeout)
+    use_cache = RESPONSE_CACHE_ENABLED and model.meta.cache_ttl > 0
+    model_id = model.meta.model_id
+    key = make_request_key(model_id, (prompt,), {})
+
+    if use_cache:
+        cached = await ResponseCache().get(model_id, key)
+        if isinstance(cached, str):
+            print(f"Response cache hit for {model_id}")
+            yield cached
+            return
+
+    breaker = get_breaker(model.meta.model_id)
+    controller = get_admission_controller(model.meta.provider, model.meta.model_id)
+    chunks = []
+    try:
+        async with controller.admit(estimate_tokens(prompt),
+                                   max_wait=admission_wait(model.meta.provider, deadline.remaining())):
+            if not _breaker_allows(model):
+                return
+
+            started_at = time.monotonic()
+            stream = model.stream(prompt)
+            failed = False
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=deadline.remaining())
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        _execution_stats[model_id]["timeout"] += 1
+                        raise ModelTimeoutError(f"{model_id} did not finish streaming within {deadline.timeout:.0f}s")
+                    chunks.append(chunk)
+                    yield chunk
+            except ModelTimeoutError:
+                failed = True
+                raise
+            except (Exception, asyncio.CancelledError) as e:
+                # Поток, оборванный после первых кусков, - неудачный вызов, а не короткий ответ.
+                failed = True
+                if not isinstance(e, asyncio.CancelledError):
+                    _execution_stats[model_id]["error"] += 1
+                raise
+            finally:
+                await stream.aclose()
+                breaker.record(bool(chunks) and not failed, time.monotonic() - started_at)
+        _execution_stats[model_id]["ok" if chunks else "error"] += 1
+    except AdmissionTimeout as e:
+        print(e)
+        return
+
+    if chunks:
+        controller.on_success()
+
+    if use_cache:
+        await ResponseCache().put(key, "".join(chunks), model.meta.cache_ttl)
+
+
+def _is_fallback_candidate(meta: ModelInfo, capability: Type[BaseAIModel]) -> bool:
+    if capability not in meta.capabilities or get_breaker(meta.model_id).is_open():
+        return False
+    # Скрытые модели (например, Whisper для расшифровки голосовых) ждут служебный ввод, а не запрос пользователя.
+    if not meta.is_available_to_user:
+        return False
+    # Модель с генерацией картинок на текстовый запрос ответит изображением, для текста она не подходит.
+    return not (capability is TextToTextModel and TextToImgModel in meta.capabilities)
+
+
+def get_fallback_chain(meta: ModelInfo, capability: Type[BaseAIModel]) -> List[ModelInfo]:
+    registry = AIRegistry()
+    configured = [registry.get_model_info_by_id(model_id) for model_id in _fallback_chains.get(meta.model_id, [])]
+    candidates = [info for info in configured if info is not None]
+    candidates += [info for info in registry.get_model_infos_by_type(capability) if info not in candidates]
+    return [info for info in candidates
+            if info.model_id != meta.model_id and _is_fallback_candidate(info, capability)][:MAX_FALLBACK_ATTEMPTS]
+
+
+async def _attempt(model: BaseAIModel, args, kwargs, deadline: Deadline):
+    """Одна попытка цепочки: ошибка модели считается неудачной попыткой, а не прерывает цепочку."""
+    try:
+        return await execute_model(model, *args, deadline=deadline, **kwargs)
+    except ModelTimeoutError:
+        raise
+    except Exception as e:
+        print(f"Model {model.meta.model_id} failed: {e}")
+        return None
+
+
+async def execute_with_fallback(model: BaseAIModel, capability: Type[BaseAIModel], *args,
+                                deadline: Optional[Deadline] = None, try_primary: bool = True,
+                                **kwargs) -> Tuple[Optional[object], BaseAIModel]:
+    """
+    Вызывает модель, а если ее размыкатель открыт, она не ответила или упала с ошибкой - резервные
+    модели с той же возможностью. Все попытки укладываются в один дедлайн запроса; если он истек,
+    так и не дав ответа, выбрасывается ModelTimeoutError. С try_primary=False сразу вызываются
+    резервные модели (например, после неудачного стриминга основной).
+    Возвращает ответ и модель, которая его дала.
+    """
+    if deadline is None:
+        deadline = Deadline(model.meta.timeout)
+    timeout_error = None
+
+    if try_primary:
+        try:
+            response = await _attempt(model, args, kwargs, deadline)
+            if response is not None:
+                return response, model
+        except ModelTimeoutError as e:
+            timeout_error = e
+
+    registry = AIRegistry()
+    for fallback_info in get_fallback_chain(model.meta, capability):
+        if deadline.expired():
+            break
+        fallback = registry.get_model_by_id(fallback_info.model_id)
+        print(f"Falling back from {model.meta.model_id} to {fallback_info.model_id}")
+        try:
+            response = await _attempt(fallback, args, kwargs, deadline)
+        except ModelTimeoutError as e:
+            timeout_error = e
+            continue
+        if response is not None:
+            return response, fallback
+
+    if timeout_error is not None and deadline.expired():
+        raise timeout_error
+    return None, model
+
+
+async def start_stream(model: BaseAIModel, prompt: str,
+                       deadline: Optional[Deadline] = None) -> Optional[AsyncIterator[str]]:
+    """
+    Запускает stream_model и дожидается первого куска ответа. Если поток оборвался раньше
+    (ошибка модели, открытый размыкатель, лимит провайдера), возвращает None, и запрос можно
+    передать резервным моделям без стриминга. Ошибки после первого куска пробрасываются.
+    """
+    stream = stream_model(model, prompt, deadline=deadline)
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+    except ModelTimeoutError:
+        raise
+    except Exception as e:
+        print(f"Streaming from {model.meta.model_id} failed before the first chunk: {e}")
+        await stream.aclose()
+        return None
+
+    async def chunks() -> AsyncIterator[str]:
+        try:
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    return chunks()
@@ -1,22 +1,103 @@
+import asyncio
 import random
+import time
 from io import BytesIO
+from typing import Awaitable, Callable, List
 
 from aiogram import Router, types, F
 from aiogram.fsm.context import FSMContext
 
-from database import get_model_rating, update_model_rating, can_afford_cost, DEFAULT_DAILY_QUOTA, get_user_quota_info, \
-    consume_quota, quota_check
-from handlers.response_handler import handle_model_response
+from database import record_vote, quota_check, LeaderboardCache
+from execution import execute_model
+from handlers.response_handler import handle_model_response, handle_model_timeout
 from keyboards.inline_keyboards import get_arena_vote_keyboard
 from keyboards.reply_keyboards import get_settings_reply_keyboard
-from registry import AIRegistry, TextToTextModel, TextToImgModel, ImgToTextModel, AudioToTextModel
+from registry import AIRegistry, BaseAIModel, TextToTextModel, TextToImgModel, ImgToTextModel, AudioToTextModel
 from states import ChatState
+from utils.circuit_breaker import get_breaker
+from utils.deadline import Deadline, ModelTimeoutError
+from utils.matchmaking import MatchCandidate, choose_pair, MATCHMAKING_ENABLED
 from utils.transcription import transcribe_voice_message
-from utils.utils import calculate_elo_update
 
 router = Router()
 
 
+async def _choose_arena_pair(models: List[BaseAIModel], arena_vote_type: str) -> List[BaseAIModel]:
+    """
+    Выбирает пару моделей для арены: чаще сравниваются модели с близкими и менее
+    надежными рейтингами в этой арене, реже - модели с ошибками и медленными ответами.
+    """
+    if not MATCHMAKING_ENABLED:
+        return random.sample(models, 2)
+
+    entries = {entry.model_id: entry for entry in await LeaderboardCache().get(arena_vote_type, limit=None)}
+    candidates = []
+    for model in models:
+        model_id = model.meta.model_id
+        entry = entries.get(model_id)
+        candidates.append(MatchCandidate(
+            model_id,
+            rating=entry.rating if entry else 1000,
+            votes=entry.votes if entry else 0,
+            health=get_breaker(model_id).health(),
+        ))
+
+    first, second = choose_pair(candidates)
+    models_by_id = {model.meta.model_id: model for model in models}
+    return [models_by_id[first.model_id], models_by_id[second.model_id]]
+
+
+ARENA_PAIR_KEYS = ("arena_current_pair", "arena_vote_type", "arena_pair_created_at")
+
+
+async def _save_arena_pair(state: FSMContext, models: List[BaseAIModel], arena_vote_type: str) -> None:
+    # В FSM хранятся только примитивы, чтобы состояние можно было держать во внешнем хранилище.
+    await state.update_data(
+        arena_current_pair=[model.meta.model_id for model in models],
+        arena_vote_type=arena_vote_type,
+        arena_pair_created_at=int(time.time()),
+    )
+
+
+async def _run_arena_models(message: types.Message, models: List[BaseAIModel],
+                            run_model: Callable[[BaseAIModel], Awaitable], quota_per_success: int) -> int:
+    """
+    Запускает обе модели арены одновременно и отправляет каждый ответ, как только он готов.
+    Номер ответа закреплен за позицией модели в паре, а не за порядком завершения.
+    Возвращает квоту, которую нужно списать за успешные ответы.
+    """
+
+    async def run_indexed(index: int, model: BaseAIModel):
+        timed_out = False
+        try:
+            response = await run_model(model)
+        except ModelTimeoutError as e:
+            print(e)
+            response = None
+            timed_out = True
+        except Exception as e:
+            print(e)
+            response = None
+        return index, model, response, timed_out
+
+    tasks = [asyncio.create_task(run_indexed(index, model)) for index, model in enumerate(models)]
+    quota_to_consume = 0
+    try:
+        for next_finished in asyncio.as_completed(tasks):
+            index, model, response, timed_out = await next_finished
+            await message.answer(f"Ответ {index + 1} модели:")
+            if timed_out:
+                await handle_model_timeout(message)
+            elif await handle_model_response(message, response):
+                print(f"ARENA: Model {model.meta.model_id} returned a response")
+                quota_to_consume += quota_per_success
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return quota_to_consume
+
+
 @router.message(F.text, ChatState.waiting_arena_query)
 @quota_check(4)
 async def arena_text_query_handler(message: types.Message, state: FSMContext):
@@ -42,28 +123,25 @@ async def arena_text_query_handler(message: types.Message, state: FSMContext):
                              reply_markup=get_settings_reply_keyboard())
         return
 
-    models = random.sample(models, 2)
+    models = await _choose_arena_pair(models, arena_type)
     print(
-        f"ARENA Handler (Text): Chosen models: {', '.join(f'{model.meta.provider}:{model.meta.version}' for model in models)}")
-    quota_to_consume_after_models_work = 0
-    for index, model in enumerate(models):
-        try:
-            if arena_type == "text" and TextToImgModel in model.meta.capabilities:
-                response = await model.execute(message.text, enforce_text_response=True)
-            else:
-                response = await model.execute(message.text)
-        except Exception as e:
-            print(e)
-            response = None
-        await message.answer(f"Ответ {index + 1} модели:")
-        if await handle_model_response(message, response):
-            quota_to_consume_after_models_work += 2 if arena_type == "image" else 1
+        f"ARENA Handler (Text): Chosen models: {', '.join(model.meta.model_id for model in models)}")
+
+    deadline = Deadline.for_models(models)
 
-    consume_quota(message.from_user.id, quota_to_consume_after_models_work)
+    async def run_model(model: BaseAIModel):
+        if arena_type == "text" and TextToImgModel in model.meta.capabilities:
+            return await execute_model(model, message.text, enforce_text_response=True, deadline=deadline)
+        return await execute_model(model, message.text, deadline=deadline)
 
-    await state.update_data(arena_current_pair=(models[0], models[1]))
+    quota_to_consume_after_models_work = await _run_arena_models(
+        message, models, run_model, quota_per_success=2 if arena_type == "image" else 1
+    )
+
+    await _save_arena_pair(state, models, arena_type)
     await state.set_state(ChatState.waiting_arena_vote)
     await message.answer("Выберите лучший ответ:", reply_markup=get_arena_vote_keyboard())
+    return quota_to_consume_after_models_work
 
 
 @router.message(F.photo, ChatState.waiting_arena_query)
@@ -89,32 +167,25 @@ async def arena_photo_query_handler(message: types.Message, state: FSMContext):
                              reply_markup=get_settings_reply_keyboard())
         return
 
-    models = random.sample(models, 2)
+    models = await _choose_arena_pair(models, "photo")
     print(
-        f"ARENA Handler (Photo): Chosen models: {', '.join(f'{model.meta.provider}:{model.meta.version}' for model in models)}")
-    quota_to_consume_after_models_work = 0
+        f"ARENA Handler (Photo): Chosen models: {', '.join(model.meta.model_id for model in models)}")
 
     photo = message.photo[-1]
-    photo_bytes = await message.bot.download(photo)
-    image_data = BytesIO(photo_bytes.read())
+    photo_bytes = (await message.bot.download(photo)).read()
     prompt = message.caption or ""
 
-    for index, model in enumerate(models):
-        try:
-            response = await model.execute(image_data, prompt)
-        except Exception as e:
-            print(e)
-            response = None
-        await message.answer(f"Ответ {index + 1} модели:")
-        if await handle_model_response(message, response):
-            print(f"ARENA Handler (Photo): Model {model.meta.provider}:{model.meta.version} returned a response")
-            quota_to_consume_after_models_work += 1
+    deadline = Deadline.for_models(models)
 
-    consume_quota(message.from_user.id, quota_to_consume_after_models_work)
+    async def run_model(model: BaseAIModel):
+        return await execute_model(model, BytesIO(photo_bytes), prompt, deadline=deadline)
 
-    await state.update_data(arena_current_pair=(models[0], models[1]))
+    quota_to_consume_after_models_work = await _run_arena_models(message, models, run_model, quota_per_success=1)
+
+    await _save_arena_pair(state, models, "photo")
     await state.set_state(ChatState.waiting_arena_vote)
     await message.answer("Выберите лучший ответ:", reply_markup=get_arena_vote_keyboard())
+    return quota_to_consume_after_models_work
 
 
 @router.message(F.voice, ChatState.waiting_arena_query)
@@ -143,41 +214,53 @@ async def arena_voice_query_handler(message: types.Message, state: FSMContext):
                              reply_markup=get_settings_reply_keyboard())
         return
 
-    models = random.sample(models, 2)
+    models = await _choose_arena_pair(models, "voice")
     print(
-        f"ARENA Handler (Voice): Chosen models: {', '.join(f'{model.meta.provider}:{model.meta.version}' for model in models)}")
-    quota_to_consume_after_models_work = 0
-
-    for index, model in enumerate(models):
+        f"ARENA Handler (Voice): Chosen models: {', '.join(model.meta.model_id for model in models)}")
+
+    # Дедлайн создается до скачивания и расшифровки голоса: они входят в общий бюджет запроса.
+    deadline = Deadline.for_models(models)
+
+    # Голос скачивается и транскрибируется один раз на пару, транскрипция идет параллельно с аудио-моделью.
+    voice_bytes = None
+    if any(AudioToTextModel in model.meta.capabilities for model in models):
+        voice_bytes = (await message.bot.download(message.voice)).read()
+    transcription_task = None
+    if any(AudioToTextModel not in model.meta.capabilities for model in models):
+        transcription_task = asyncio.create_task(transcribe_voice_message(message, registry, deadline=deadline))
+        # Ошибку расшифровки получают модели, которые ее ждут; если они уже ушли, она не должна теряться молча.
+        transcription_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def run_model(model: BaseAIModel):
+        if AudioToTextModel in model.meta.capabilities:
+            return await execute_model(model, BytesIO(voice_bytes), deadline=deadline)
         try:
-            if AudioToTextModel in model.meta.capabilities:
-                voice = message.voice
-                voice_bytes = await message.bot.download(voice)
-                voice_data = BytesIO(voice_bytes.read())
-                response = await model.execute(voice_data)
-            else:
-                text = await transcribe_voice_message(message, registry)
-                response = await model.execute(text)
-        except Exception as e:
-            print(e)
-            response = None
-        await message.answer(f"Ответ {index + 1} модели:")
-        if await handle_model_response(message, response):
-            quota_to_consume_after_models_work += 1
+            text = await asyncio.wait_for(asyncio.shield(transcription_task), timeout=deadline.remaining())
+        except asyncio.TimeoutError:
+            raise ModelTimeoutError(f"Voice transcription did not finish within {deadline.timeout:.0f}s")
+        return await execute_model(model, text, deadline=deadline)
 
-    consume_quota(message.from_user.id, quota_to_consume_after_models_work)
-    await state.update_data(arena_current_pair=(models[0], models[1]))
+    try:
+        quota_to_consume_after_models_work = await _run_arena_models(message, models, run_model, quota_per_success=1)
+    finally:
+        if transcription_task:
+            transcription_task.cancel()
+
+    await _save_arena_pair(state, models, "voice")
     await state.set_state(ChatState.waiting_arena_vote)
     await message.answer("Выберите лучший ответ:", reply_markup=get_arena_vote_keyboard())
+    return quota_to_consume_after_models_work
 
 
 @router.callback_query(F.data.startswith("vote_"), ChatState.waiting_arena_vote)
 async def arena_vote_handler(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    model_objects = data.get('arena_current_pair')
+    model_ids = data.get('arena_current_pair')
+    registry = AIRegistry()
 
-    if not model_objects or len(model_objects) != 2:
-        print("Error: Invalid 'arena_current_pair' data in state.")
+    if (not model_ids or len(model_ids) != 2
+            or not all(isinstance(model_id, str) and registry.get_model_info_by_id(model_id) for model_id in model_ids)):
+        print(f"Error: Invalid 'arena_current_pair' data in state: {model_ids}")
         await callback.answer("Произошла ошибка при обработке голоса. Попробуйте снова.", show_alert=True)
         await state.set_state(ChatState.waiting_arena_query)
         try:
@@ -187,69 +270,33 @@ async def arena_vote_handler(callback: types.CallbackQuery, state: FSMContext):
             pass
         return
 
-    try:
-        model_id_1 = f"{model_objects[0].meta.provider.lower()}:{model_objects[0].meta.version}"
-        model_id_2 = f"{model_objects[1].meta.provider.lower()}:{model_objects[1].meta.version}"
-        print(f"ARENA Vote Handler: Got vote {callback.data} for pair IDs: [{model_id_1}, {model_id_2}]")
-    except AttributeError as e:
-        print(f"Error: Could not extract model ID from state objects: {e}. Objects: {model_objects}")
-        await callback.answer("Произошла ошибка данных моделей. Попробуйте снова.", show_alert=True)
-        await state.set_state(ChatState.waiting_arena_query)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=None)
-        except Exception as e:
-            print(f"Error editing reply markup: {e}")
-            pass
-        return
+    model_id_1, model_id_2 = model_ids
+    print(f"ARENA Vote Handler: Got vote {callback.data} for pair IDs: [{model_id_1}, {model_id_2}]")
 
     vote = callback.data.split("_")[1]
-    winner_model_id = None
-    is_tie = False
 
     if vote == "1":
-        winner_model_id = model_id_1
-        print(f"Voted for model 1 ID: {winner_model_id}")
+        outcome = "a"
+        print(f"Voted for model 1 ID: {model_id_1}")
     elif vote == "2":
-        winner_model_id = model_id_2
-        print(f"Voted for model 2 ID: {winner_model_id}")
+        outcome = "b"
+        print(f"Voted for model 2 ID: {model_id_2}")
     elif vote == "tie":
-        is_tie = True
+        outcome = "tie"
         print(f"Voted TIE for {model_id_1} vs {model_id_2}")
     else:
         print(f"Unexpected vote value: {vote}")
         await callback.answer("Некорректный голос, попробуйте еще раз", show_alert=True)
         return
 
-    try:
-        rating1 = get_model_rating(model_id_1)
-        rating2 = get_model_rating(model_id_2)
-
-        if rating1 is not None and rating2 is not None:
-            if is_tie:
-                new_rating1, new_rating2 = calculate_elo_update(rating1, rating2, score_a=0.5)
-            elif winner_model_id:
-                if winner_model_id == model_id_1:
-                    new_rating1, new_rating2 = calculate_elo_update(rating1, rating2, score_a=1.0)
-                else:
-                    new_rating2, new_rating1 = calculate_elo_update(rating2, rating1, score_a=1.0)
-            else:
-                print("Error: Vote processed but no winner/loser/tie identified for rating calculation.")
-                raise ValueError("Rating calculation logic error")
-
-            update_model_rating(model_id_1, new_rating1)
-            update_model_rating(model_id_2, new_rating2)
-            print(f"Ratings updated: {model_id_1}={new_rating1}, {model_id_2}={new_rating2}")
-
-        else:
-            print(
-                f"Error: Could not retrieve ratings for one or both models: {model_id_1} ({rating1}), {model_id_2} ({rating2})")
-
-    except Exception as e:
-        print(f"Error during rating update process: {e}")
+    arena_vote_type = data.get('arena_vote_type') or data.get('arena_type') or "text"
+    new_ratings = await record_vote(model_id_1, model_id_2, outcome, arena_vote_type, callback.from_user.id)
+    if new_ratings:
+        print(f"Ratings updated: {model_id_1}={new_ratings[0]}, {model_id_2}={new_ratings[1]}")
 
     await callback.answer("Ваш голос принят!")
 
-    await state.update_data(arena_current_pair=None)
+    await state.set_data({key: value for key, value in data.items() if key not in ARENA_PAIR_KEYS})
     await state.set_state(ChatState.waiting_arena_query)
 
     try:
@@ -0,0 +1,41 @@
+from aiogram import Router, types
+from aiogram.filters import Command, CommandObject
+
+from database import LeaderboardCache, ARENA_TYPES
+
+router = Router()
+
+ARENA_TYPE_TITLES = {
+    "text": "✍️ Текстовая арена",
+    "image": "🖼️ Арена изображений",
+    "photo": "📷 Запросы с фото",
+    "voice": "🎙️ Голосовые запросы",
+}
+
+
+@router.message(Command("leaderboard"))
+async def leaderboard_handler(message: types.Message, command: CommandObject) -> None:
+    arena_types = ARENA_TYPES
+    if command.args:
+        arena_type = command.args.strip().lower()
+        if arena_type not in ARENA_TYPES:
+            await message.answer(f"Неизвестный тип арены. Доступны: {', '.join(ARENA_TYPES)}")
+            return
+        arena_types = (arena_type,)
+
+    leaderboard = LeaderboardCache()
+    sections = []
+    for arena_type in arena_types:
+        entries = await leaderboard.get(arena_type)
+        if not entries:
+            continue
+        lines = [f"{ARENA_TYPE_TITLES[arena_type]}:"]
+        for place, entry in enumerate(entries, start=1):
+            lines.append(f"{place}. {entry.display_name} - {entry.rating} (голосов: {entry.votes})")
+        sections.append("\n".join(lines))
+
+    if not sections:
+        await message.answer("🏆 Пока нет голосов в арене. Проголосуйте в режиме '✨ Арена ✨', чтобы заполнить рейтинг.")
+        return
+
+    await message.answer("🏆 Рейтинг моделей\n\n" + "\n\n".join(sections))
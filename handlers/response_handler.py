@@ -1,14 +1,29 @@
+import asyncio
 import io
+import os
+import time
 import aiogram.exceptions
 
 from io import BytesIO
+from typing import AsyncIterator, Optional
 from PIL import Image
 from aiogram import types
+from utils.deadline import ModelTimeoutError
+from utils.progress import JobProgress, ProgressCallback
 from utils.utils import split_text
 from aiogram.enums import ParseMode
 from aiogram.types import BufferedInputFile
 from keyboards.reply_keyboards import get_settings_reply_keyboard
 
+# Telegram ограничивает частоту редактирования сообщений, поэтому при стриминге
+# сообщение обновляется не чаще одного раза в STREAM_EDIT_INTERVAL секунд.
+STREAMING_ENABLED = os.getenv('STREAMING_ENABLED', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Место в очереди и прогресс генерации в Gradio Spaces показываются в сообщении-заглушке
+# не чаще одного раза в PROGRESS_EDIT_INTERVAL секунд.
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '3.0'))
+
 
 async def handle_model_response(message: types.Message, response) -> bool:
     success = False
@@ -105,3 +120,176 @@ async def handle_model_response(message: types.Message, response) -> bool:
         success = False
 
     return success
+
+
+async def handle_model_timeout(message: types.Message) -> bool:
+    try:
+        await message.answer(
+            "⌛ Модель не успела ответить за отведенное время, попробуйте позже.",
+            reply_markup=get_settings_reply_keyboard()
+        )
+    except Exception as send_error:
+        print(f"Error sending timeout message: {send_error}")
+    return False
+
+
+def format_job_progress(progress: JobProgress) -> str:
+    if progress.stage == "queue":
+        text = "⏳ Запрос в очереди"
+        if progress.rank is not None:
+            text += f": позиция {progress.rank + 1}"
+            if progress.queue_size:
+                text += f" из {progress.queue_size}"
+    else:
+        text = "⚙️ Модель генерирует ответ"
+        if progress.fraction is not None:
+            text += f": {progress.fraction:.0%}"
+    if progress.eta:
+        text += f", осталось около {progress.eta:.0f} с"
+    return text
+
+
+def make_progress_callback(placeholder: types.Message) -> ProgressCallback:
+    """
+    Возвращает колбэк для progress_reporter, который показывает прогресс задачи в placeholder.
+    """
+    shown_text = placeholder.text
+    next_edit_at = 0.0
+
+    async def show_progress(progress: JobProgress) -> None:
+        nonlocal shown_text, next_edit_at
+        now = time.monotonic()
+        text = format_job_progress(progress)
+        if text == shown_text or now < next_edit_at:
+            return
+        try:
+            await placeholder.edit_text(text)
+            shown_text = text
+            next_edit_at = now + PROGRESS_EDIT_INTERVAL
+        except aiogram.exceptions.TelegramRetryAfter as e:
+            print(f"Progress edit throttled by Telegram for {e.retry_after}s")
+            next_edit_at = now + e.retry_after
+
+    return show_progress
+
+
+async def _edit_stream_message(message: types.Message, sent: Optional[types.Message], text: str,
+                               final: bool = False, reply_markup=None) -> types.Message:
+    if sent is None:
+        if final:
+            try:
+                return await message.answer(text=text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN,
+                                            disable_web_page_preview=True)
+            except aiogram.exceptions.TelegramRetryAfter:
+                raise
+            except aiogram.exceptions.TelegramAPIError as e_md:
+                print(f"Markdown send failed: {e_md}. Retrying without Markdown.")
+        return await message.answer(text=text, reply_markup=reply_markup, disable_web_page_preview=True)
+
+    if final:
+        try:
+            return await sent.edit_text(text=text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        except aiogram.exceptions.TelegramRetryAfter:
+            raise
+        except aiogram.exceptions.TelegramAPIError as e_md:
+            print(f"Markdown edit failed: {e_md}. Retrying without Markdown.")
+
+    try:
+        await sent.edit_text(text=text, disable_web_page_preview=True)
+    except aiogram.exceptions.TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    return sent
+
+
+async def _finish_stream_message(message: types.Message, sent: Optional[types.Message], text: str,
+                                 reply_markup=None) -> types.Message:
+    """
+    Отправляет завершенную часть ответа. Ее нельзя пропустить, поэтому при ограничении частоты
+    Telegram запрос повторяется после паузы.
+    """
+    if reply_markup is not None and sent is not None:
+        # Reply-клавиатуру нельзя добавить редактированием: последняя часть отправляется заново.
+        try:
+            await sent.delete()
+        except aiogram.exceptions.TelegramAPIError as e:
+            print(f"Error deleting streamed message: {e}")
+        sent = None
+    while True:
+        try:
+            return await _edit_stream_message(message, sent, text, final=True, reply_markup=reply_markup)
+        except aiogram.exceptions.TelegramRetryAfter as e:
+            print(f"Stream message throttled by Telegram for {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+
+
+async def handle_model_stream(message: types.Message, chunks: AsyncIterator[str],
+                              placeholder: Optional[types.Message] = None) -> bool:
+    """
+    Показывает потоковый ответ модели, редактируя одно сообщение (начиная с placeholder).
+    При превышении лимита длины сообщения (см. split_text) продолжает в новом сообщении.
+    Последняя часть отправляется новым сообщением с клавиатурой настроек. Если поток оборвался
+    ошибкой модели, полученный текст остается, а пользователь видит, что ответ неполный.
+    """
+    sent = placeholder
+    text = ""
+    shown_text = None
+    received_any = False
+    interrupted = False
+    next_edit_at = 0.0
+
+    try:
+        while True:
+            # Ошибки Telegram обрабатываются ниже, а здесь - только ошибки самой модели.
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            except ModelTimeoutError:
+                raise
+            except Exception as e:
+                print(f"Model stream interrupted: {e}")
+                interrupted = True
+                break
+            received_any = True
+            text += chunk
+
+            parts = split_text(text, TELEGRAM_MESSAGE_LIMIT)
+            if len(parts) > 1:
+                for part in parts[:-1]:
+                    await _finish_stream_message(message, sent, part)
+                    sent = None
+                text = parts[-1]
+                shown_text = None
+
+            now = time.monotonic()
+            if text and text != shown_text and now >= next_edit_at:
+                try:
+                    sent = await _edit_stream_message(message, sent, text)
+                    shown_text = text
+                except aiogram.exceptions.TelegramRetryAfter as e:
+                    print(f"Stream edit throttled by Telegram for {e.retry_after}s")
+                    next_edit_at = now + e.retry_after
+                    continue
+                next_edit_at = now + STREAM_EDIT_INTERVAL
+
+        if interrupted:
+            if text.strip():
+                await _finish_stream_message(message, sent, text)
+            await message.answer("⚠️ Ответ не завершен: модель прервала генерацию, попробуйте еще раз.",
+                                 reply_markup=get_settings_reply_keyboard())
+            return False
+
+        if not received_any or not text.strip():
+            return await handle_model_response(message, "" if received_any else None)
+
+        await _finish_stream_message(message, sent, text, reply_markup=get_settings_reply_keyboard())
+        return True
+
+    except aiogram.exceptions.TelegramAPIError as e:
+        print(f"Error while streaming response: {e}")
+        try:
+            await message.answer("⚠️ Ошибка отправки части сообщения.", reply_markup=get_settings_reply_keyboard())
+        except Exception as send_error:
+            print(f"Error sending streaming error message: {send_error}")
+        return False
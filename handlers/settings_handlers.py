@@ -22,7 +22,7 @@ async def command_start_handler(message: types.Message, state: FSMContext) -> No
     print(f"User {user_name} (ID: {user_id}) started the bot.")
 
     try:
-        database.register_or_check_user(user_id)
+        await database.register_or_check_user(user_id)
         print(f"User {user_id} checked/registered in DB.")
 
     except Exception as e:
@@ -106,16 +106,17 @@ async def choose_provider_handler(callback: types.CallbackQuery, state: FSMConte
 @router.callback_query(SettingsState.choosing_model, F.data.startswith("model_"))
 async def choose_model_handler(callback: types.CallbackQuery, state: FSMContext):
     _, provider, version = callback.data.split("_")
+    model_info = AIRegistry().get_model_info(provider, version)
+    if not model_info:
+        await callback.answer("Модель не найдена.", show_alert=True)
+        return
 
-    await state.update_data(
-        model_id=f"{provider}:{version}",
-        model_name=f"{provider} {version}"
-    )
+    await state.update_data(model_id=model_info.model_id)
 
     await callback.message.delete()
     await callback.message.answer(
         f"✅ Выбрана модель: {version}\n"
-        f"Это {AIRegistry().get_model(provider, version).meta.description}\n"
+        f"Это {model_info.description}\n"
         "Теперь можете отправлять запросы!",
         reply_markup=get_settings_reply_keyboard()
     )
@@ -147,10 +148,12 @@ async def back_to_mode_handler(callback: types.CallbackQuery, state: FSMContext)
 @router.callback_query(SettingsState.choosing_provider, F.data.startswith("model_"))
 async def choose_model_handler(callback: types.CallbackQuery, state: FSMContext):
     _, provider, version = callback.data.split("_")
-    await state.update_data(
-        model_id=f"{provider}:{version}",
-        model_name=f"{provider} {version}"
-    )
+    model_info = AIRegistry().get_model_info(provider, version)
+    if not model_info:
+        await callback.answer("Модель не найдена.", show_alert=True)
+        return
+
+    await state.update_data(model_id=model_info.model_id)
     await callback.message.delete()
     await callback.message.answer(
         f"Выбрана модель: {provider} {version}",
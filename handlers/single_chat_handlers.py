@@ -2,45 +2,73 @@ from aiogram import Router, types, F
 from aiogram.fsm.context import FSMContext
 from io import BytesIO
 
-from database import can_afford_cost, get_user_quota_info, DEFAULT_DAILY_QUOTA, quota_check
-from handlers.response_handler import handle_model_response
+from database import quota_check
+from execution import execute_with_fallback, start_stream
+from handlers.response_handler import handle_model_response, handle_model_stream, handle_model_timeout, \
+    make_progress_callback, STREAMING_ENABLED
 from states import ChatState
 from keyboards.reply_keyboards import get_settings_reply_keyboard
-from registry import AIRegistry, TextToTextModel, TextToImgModel, ImgToTextModel, AudioToTextModel
+from registry import AIRegistry, BaseAIModel, TextToTextModel, TextToImgModel, ImgToTextModel, AudioToTextModel
+from utils.circuit_breaker import get_breaker
+from utils.deadline import Deadline, ModelTimeoutError
+from utils.progress import progress_reporter
 from utils.transcription import transcribe_voice_message
 
 router = Router()
 
 
+def _text_capability(model: BaseAIModel):
+    return TextToImgModel if TextToImgModel in model.meta.capabilities else TextToTextModel
+
+
+async def _notify_fallback(message: types.Message, requested: BaseAIModel, answered: BaseAIModel) -> None:
+    if answered is not requested:
+        await message.answer(
+            f"ℹ️ Модель {requested.meta.display_name} сейчас недоступна, "
+            f"ответ подготовила модель {answered.meta.display_name}."
+        )
+
+
 @router.message(ChatState.waiting_single_query, F.voice)
 @quota_check(1)
 async def voice_query_handler(message: types.Message, state: FSMContext) -> None:
-    await message.answer("⏳")
+    placeholder = await message.answer("⏳")
     user_data = await state.get_data()
     model_id = user_data.get("model_id", "default")
     registry = AIRegistry()
 
     try:
-        provider, version = model_id.split(":")
-        model = registry.get_model(provider, version)
+        model = registry.get_model_by_id(model_id)
 
         if not model:
             await message.answer(f"❓️ Модель {model_id} не найдена")
             return
 
         response = None
+        answered_by = model
 
         if AudioToTextModel in model.meta.capabilities:
             voice = message.voice
             voice_bytes = await message.bot.download(voice)
             voice_data = BytesIO(voice_bytes.read())
-            response = await model.execute(voice_data)
+            deadline = Deadline.for_models([model])
+            with progress_reporter(make_progress_callback(placeholder)):
+                response, answered_by = await execute_with_fallback(model, AudioToTextModel, voice_data,
+                                                                    deadline=deadline)
         elif TextToTextModel in model.meta.capabilities or TextToImgModel in model.meta.capabilities:
-            text = await transcribe_voice_message(message, registry)
-            response = await model.execute(text)
-
+            # Расшифровка голоса входит в дедлайн запроса вместе с ответом модели.
+            deadline = Deadline.for_models([model])
+            text = await transcribe_voice_message(message, registry, deadline=deadline)
+            with progress_reporter(make_progress_callback(placeholder)):
+                response, answered_by = await execute_with_fallback(model, _text_capability(model), text,
+                                                                    deadline=deadline)
+
+        await _notify_fallback(message, model, answered_by)
         await handle_model_response(message, response)
 
+    except ModelTimeoutError as e:
+        print(e)
+        await handle_model_timeout(message)
     except Exception as e:
         print(e)
         await message.answer(
@@ -53,7 +81,7 @@ async def voice_query_handler(message: types.Message, state: FSMContext) -> None
 @router.message(ChatState.waiting_single_query, F.photo)
 @quota_check(1)
 async def photo_query_handler(message: types.Message, state: FSMContext) -> None:
-    await message.answer("⏳")
+    placeholder = await message.answer("⏳")
     user_data = await state.get_data()
     model_id = user_data.get("model_id", "default")
     registry = AIRegistry()
@@ -64,20 +92,26 @@ async def photo_query_handler(message: types.Message, state: FSMContext) -> None
         image_data = BytesIO(photo_bytes.read())
         prompt = message.caption or ""
 
-        provider, version = model_id.split(":")
-        model = registry.get_model(provider, version)
+        model = registry.get_model_by_id(model_id)
 
         if not model:
             await message.answer(f"❓️ Модель {model_id} не найдена")
             return
 
         if ImgToTextModel in model.meta.capabilities:
-            response = await model.execute(image_data, prompt)
+            deadline = Deadline.for_models([model])
+            with progress_reporter(make_progress_callback(placeholder)):
+                response, answered_by = await execute_with_fallback(model, ImgToTextModel, image_data, prompt,
+                                                                    deadline=deadline)
+            await _notify_fallback(message, model, answered_by)
         else:
             response = f"🚫 Модель {model_id} не поддерживает обработку изображений"
 
         await handle_model_response(message, response)
 
+    except ModelTimeoutError as e:
+        print(e)
+        await handle_model_timeout(message)
     except Exception as e:
         print(e)
         await message.answer(f"⚠️ Ошибка, пожалуйста, попробуйте еще раз позже",
@@ -87,7 +121,7 @@ async def photo_query_handler(message: types.Message, state: FSMContext) -> None
 @router.message(ChatState.waiting_single_query, F.text)
 @quota_check(1)
 async def text_query_handler(message: types.Message, state: FSMContext) -> None:
-    await message.answer("⏳")
+    placeholder = await message.answer("⏳")
     user_data = await state.get_data()
     model_id = user_data.get("model_id", "default")
     registry = AIRegistry()
@@ -97,15 +131,30 @@ async def text_query_handler(message: types.Message, state: FSMContext) -> None:
             await message.answer("Режим по умолчанию не активирован")
             return
 
-        provider, version = model_id.split(":")
-        model = registry.get_model(provider, version)
+        model = registry.get_model_by_id(model_id)
 
         if not model:
             await message.answer(f"Модель {model_id} не найдена")
             return
 
-        if TextToTextModel in model.meta.capabilities or TextToImgModel in model.meta.capabilities:
-            response = await model.execute(message.text)
+        deadline = Deadline.for_models([model])
+        if (STREAMING_ENABLED and model.meta.supports_streaming
+                and TextToImgModel not in model.meta.capabilities
+                and not get_breaker(model.meta.model_id).is_open()):
+            chunks = await start_stream(model, message.text, deadline=deadline)
+            if chunks is not None:
+                await handle_model_stream(message, chunks, placeholder)
+            else:
+                # Поток оборвался до первого куска: отвечают резервные модели, уже без стриминга.
+                response, answered_by = await execute_with_fallback(model, TextToTextModel, message.text,
+                                                                    deadline=deadline, try_primary=False)
+                await _notify_fallback(message, model, answered_by)
+                await handle_model_response(message, response)
+        elif TextToTextModel in model.meta.capabilities or TextToImgModel in model.meta.capabilities:
+            with progress_reporter(make_progress_callback(placeholder)):
+                response, answered_by = await execute_with_fallback(model, _text_capability(model), message.text,
+                                                                    deadline=deadline)
+            await _notify_fallback(message, model, answered_by)
             await handle_model_response(message, response)
         else:
             await message.answer(
@@ -113,7 +162,10 @@ async def text_query_handler(message: types.Message, state: FSMContext) -> None:
                 reply_markup=get_settings_reply_keyboard()
             )
 
-    except ValueError as e:
+    except ModelTimeoutError as e:
+        print(e)
+        await handle_model_timeout(message)
+    except Exception as e:
         print(e)
         await message.answer("🚫 Не удалось получить ответ от модели", reply_markup=get_settings_reply_keyboard(),
                              parse_mode="Markdown")
@@ -26,12 +26,23 @@ def main():
         help="Enable verbose output (e.g., show skipped models)."
     )
 
+    parser.add_argument(
+        "--compact-quotas",
+        action="store_true",
+        help="Reset stale daily quota usage of all users in one statement and exit (e.g. nightly from cron)."
+    )
+
     args = parser.parse_args()
 
     db_file_display_name = database.DATABASE_FILE
 
     print(f"Using database file: {db_file_display_name}")
 
+    if args.compact_quotas:
+        database.compact_user_quotas()
+        database.close_database()
+        return
+
     if args.force_reset_models:
         print("\n--- WARNING: --force-reset-models flag detected ---")
         confirm = input(
@@ -49,7 +60,7 @@ def main():
 
     print("Loading models from registry...")
     registry = AIRegistry()
-    all_models = registry.get_all_models()
+    all_models = registry.get_all_model_infos()
 
     if not all_models:
         print("Warning: No models found in the registry. Ensure model modules are imported.")
@@ -57,10 +68,10 @@ def main():
         print(f"\nFound {len(all_models)} models in registry. Syncing with 'ai_models' table...")
         added_count = 0
         skipped_count = 0
-        for model_instance in all_models:
+        for model_info in all_models:
             try:
-                model_id = f"{model_instance.meta.provider.lower()}:{model_instance.meta.version}"
-                display_name = f"{model_instance.meta.provider} {model_instance.meta.version}"
+                model_id = model_info.model_id
+                display_name = model_info.display_name
 
                 added = database.add_model_if_not_exists(
                     model_id,
@@ -75,9 +86,9 @@ def main():
                         print(f"Model already in DB, skipped: {model_id}")
 
             except AttributeError:
-                print(f"Warning: Skipping an object that doesn't seem to be a registered model: {model_instance}")
+                print(f"Warning: Skipping an object that doesn't seem to be a registered model: {model_info}")
             except Exception as e:
-                print(f"Error processing model {getattr(model_instance, 'meta', 'UNKNOWN')}: {e}")
+                print(f"Error processing model {model_info}: {e}")
 
         print(f"\nAI Models sync finished. Added: {added_count}, Skipped: {skipped_count}")
 
@@ -92,6 +103,7 @@ def main():
 
     print("-" * 20)
     print(f"Database initialization/sync complete for '{db_file_display_name}'.")
+    database.close_database()
 
 
 if __name__ == "__main__":
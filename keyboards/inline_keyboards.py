@@ -64,13 +64,13 @@ def get_providers_keyboard() -> InlineKeyboardMarkup:
 
 def get_models_keyboard(provider: str) -> InlineKeyboardMarkup:
     registry = AIRegistry()
-    models = registry.get_models_for_provider(provider)
+    model_infos = registry.get_model_infos_for_provider(provider)
 
     buttons = []
-    for model in models:
-        version = model.meta.version
+    for meta in model_infos:
+        version = meta.version
         btn_text = f"{version}"
-        if model.meta.default:
+        if meta.default:
             btn_text += " ★"
 
         buttons.append([
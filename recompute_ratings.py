@@ -0,0 +1,95 @@
+import argparse
+import time
+
+import database
+from utils.ratings import build_vote_arrays, fit_ratings, bootstrap_intervals, ratings_table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute model ratings from the whole arena vote history.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--method",
+        choices=("bt", "elo"),
+        default="bt",
+        help="bt - Bradley-Terry maximum likelihood (order independent), elo - replay of votes in order."
+    )
+    parser.add_argument(
+        "--arena-type",
+        default=None,
+        choices=database.ARENA_TYPES,
+        help="Use only votes from this arena type and write its ratings (all votes and overall ratings by default)."
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=200,
+        help="Number of bootstrap rounds for confidence intervals (0 - skip intervals)."
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the bootstrap intervals."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes for bootstrap rounds (number of CPU cores by default)."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed for reproducible bootstrap intervals."
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="Store recomputed ratings: overall ratings in the ai_models table, "
+             "with --arena-type in the model_ratings table for that arena."
+    )
+
+    args = parser.parse_args()
+    print(f"Using database file: {database.DATABASE_FILE}")
+
+    votes = database.get_votes(args.arena_type)
+    if not votes:
+        print("No votes found.")
+        return
+
+    started_at = time.perf_counter()
+    vote_arrays = build_vote_arrays(votes)
+    ratings = fit_ratings(vote_arrays, args.method)
+    print(f"Fitted {args.method} ratings for {len(vote_arrays.model_ids)} models "
+          f"from {vote_arrays.size} votes in {time.perf_counter() - started_at:.2f}s")
+
+    lower = upper = None
+    if args.bootstrap > 0:
+        started_at = time.perf_counter()
+        lower, upper = bootstrap_intervals(vote_arrays, args.method, rounds=args.bootstrap,
+                                           confidence=args.confidence, workers=args.workers, seed=args.seed)
+        print(f"Bootstrap ({args.bootstrap} rounds) finished in {time.perf_counter() - started_at:.2f}s")
+
+    print("-" * 20)
+    for row in ratings_table(vote_arrays, ratings, lower, upper):
+        interval = f" [{row['lower']:.0f}; {row['upper']:.0f}]" if "lower" in row else ""
+        print(f"- {row['model_id']}: {row['rating']:.0f}{interval} ({row['votes']} votes)")
+
+    if args.write:
+        updated = database.set_model_ratings(
+            {model_id: round(rating) for model_id, rating in zip(vote_arrays.model_ids, ratings)},
+            args.arena_type
+        )
+        table = "model_ratings" if args.arena_type else "ai_models"
+        print(f"Ratings written to '{table}' for {updated} models.")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        database.close_database()
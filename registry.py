@@ -1,7 +1,67 @@
+import asyncio
+import os
+
 from abc import ABC, abstractmethod
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Type, Dict, List, Optional, ClassVar, Any, Tuple
+from functools import partial, cached_property
+from typing import Type, Dict, List, Optional, ClassVar, Any, Tuple, Callable
+
+# Размеры пулов потоков по умолчанию. Gradio Spaces отвечают десятки секунд,
+# поэтому им выделяется меньше потоков, чтобы они не съедали ресурсы остальных провайдеров.
+DEFAULT_PROVIDER_WORKERS = 8
+PROVIDER_WORKERS_DEFAULTS = {
+    "flux": 2,
+    "midjourney": 2,
+    "whisper": 2,
+}
+
+# TTL кэша ответов (в секундах) для моделей, которые включают кэширование через ModelInfo.cache_ttl.
+DEFAULT_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+
+_provider_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+def get_provider_pool_size(provider: str) -> int:
+    """
+    Размер пула провайдера: PROVIDER_WORKERS_<PROVIDER> > PROVIDER_WORKERS > значение по умолчанию.
+    """
+    provider = provider.lower()
+    raw_value = os.getenv(f"PROVIDER_WORKERS_{provider.upper()}") or os.getenv("PROVIDER_WORKERS")
+    if raw_value:
+        try:
+            return max(1, int(raw_value))
+        except ValueError:
+            print(f"Invalid pool size '{raw_value}' for provider {provider}, using default.")
+    return PROVIDER_WORKERS_DEFAULTS.get(provider, DEFAULT_PROVIDER_WORKERS)
+
+
+def get_provider_executor(provider: str) -> ThreadPoolExecutor:
+    provider = provider.lower()
+    executor = _provider_executors.get(provider)
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=get_provider_pool_size(provider),
+            thread_name_prefix=f"provider-{provider}"
+        )
+        _provider_executors[provider] = executor
+    return executor
+
+
+async def run_in_provider_executor(provider: str, func: Callable, *args, **kwargs):
+    """
+    Выполняет блокирующий вызов SDK в пуле потоков провайдера, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_provider_executor(provider), partial(func, *args, **kwargs))
+
+
+def shutdown_provider_executors(wait: bool = False) -> None:
+    for provider, executor in _provider_executors.items():
+        executor.shutdown(wait=wait, cancel_futures=True)
+        print(f"Executor for provider {provider} stopped")
+    _provider_executors.clear()
 
 
 class BaseAIModel(ABC):
@@ -13,19 +73,13 @@ class BaseAIModel(ABC):
     async def execute(self, *args, **kwargs):
         pass
 
+    async def run_blocking(self, func: Callable, *args, **kwargs):
+        return await run_in_provider_executor(self.meta.provider, func, *args, **kwargs)
+
 
 async def get_available_models(model_type: Type[BaseAIModel]) -> dict[str, str]:
     registry = AIRegistry()
-    models = {}
-
-    print(registry.get_models_by_type(model_type))
-    for model in registry.get_models_by_type(model_type):
-        model_id = f"{model.meta.provider.lower()}:{model.meta.version}"
-        display_name = f"{model.meta.provider} {model.meta.version}"
-
-        models[model_id] = display_name
-
-    return models
+    return {meta.model_id: meta.display_name for meta in registry.get_model_infos_by_type(model_type)}
 
 
 @dataclass
@@ -37,6 +91,22 @@ class ModelInfo:
     is_async: bool
     default: bool = False
     is_available_to_user: bool = True
+    # 0 - ответы модели не кэшируются (например, у моделей со случайным seed).
+    cache_ttl: int = 0
+    # Модель умеет отдавать текстовый ответ по частям через async-генератор stream(prompt).
+    # Ошибку генератор выбрасывает, а не завершается молча, иначе оборванный ответ не отличить от полного.
+    supports_streaming: bool = False
+    # Время ответа по умолчанию в секундах, после которого вызов отменяется.
+    timeout: float = 60
+
+    @cached_property
+    def model_id(self) -> str:
+        """Канонический идентификатор модели вида 'provider:version' (используется в БД и FSM)."""
+        return f"{self.provider.lower()}:{self.version}"
+
+    @cached_property
+    def display_name(self) -> str:
+        return f"{self.provider} {self.version}"
 
 
 class TextToTextModel(BaseAIModel):
@@ -56,64 +126,114 @@ class AudioToTextModel(BaseAIModel):
 
 
 class AIRegistry:
+    """
+    Хранит легковесные описания моделей (ModelInfo). Экземпляр модели создается
+    при первом обращении к ней, поэтому регистрация не использует сеть.
+    Индексы по возможностям, model_id и видимым пользователю провайдерам
+    строятся при регистрации, чтобы поиск в обработчиках не перебирал все модели.
+    """
     _instance = None
-    _providers: Dict[str, Dict[str, BaseAIModel]] = defaultdict(dict)
+    _providers: Dict[str, Dict[str, ModelInfo]] = defaultdict(dict)
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance._providers = defaultdict(dict)
+            cls._instance._factories = {}
+            cls._instance._instances = {}
+            cls._instance._by_id = {}
+            cls._instance._by_capability = defaultdict(list)
+            cls._instance._user_providers = []
         return cls._instance
 
+    def _add(self, meta: ModelInfo, factory: Callable[[], BaseAIModel]) -> None:
+        provider = meta.provider.lower()
+        model_id = meta.model_id
+
+        if model_id in self._by_id:
+            raise ValueError(f"Model {model_id} already exists")
+
+        self._providers[provider][meta.version] = meta
+        self._factories[model_id] = factory
+        self._by_id[model_id] = meta
+        for capability in meta.capabilities:
+            self._by_capability[capability].append(meta)
+        if meta.is_available_to_user and provider not in self._user_providers:
+            self._user_providers.append(provider)
+        print(f"Registered: {provider} {meta.version}")
+
     def add_model(self, model: BaseAIModel) -> None:
-        if not hasattr(model, 'meta'):
+        if not isinstance(getattr(model, 'meta', None), ModelInfo):
             raise ValueError("Model must have meta attribute")
 
-        provider = model.meta.provider.lower()
-        version = model.meta.version
+        self._add(model.meta, lambda: model)
+        self._instances[model.meta.model_id] = model
+
+    def add_model_class(self, cls: Type[BaseAIModel]) -> None:
+        if not isinstance(getattr(cls, 'meta', None), ModelInfo):
+            raise ValueError(f"Model class {cls.__name__} must have class attribute meta of type ModelInfo")
 
-        if version in self._providers[provider]:
-            raise ValueError(f"Model {provider}:{version} already exists")
+        self._add(cls.meta, cls)
 
-        self._providers[provider][version] = model
-        print(f"Registered: {provider} {version}")
+    def _resolve(self, model_id: str) -> Optional[BaseAIModel]:
+        model = self._instances.get(model_id)
+        if model is None:
+            factory = self._factories.get(model_id)
+            if factory is None:
+                return None
+            model = factory()
+            self._instances[model_id] = model
+            print(f"Instantiated model: {model_id}")
+        return model
 
     def get_model(self, provider: str, version: str) -> Optional[BaseAIModel]:
+        return self._resolve(f"{provider.lower()}:{version}")
+
+    def get_model_by_id(self, model_id: str) -> Optional[BaseAIModel]:
+        return self._resolve(model_id)
+
+    def get_model_info(self, provider: str, version: str) -> Optional[ModelInfo]:
         return self._providers.get(provider.lower(), {}).get(version)
 
+    def get_model_info_by_id(self, model_id: str) -> Optional[ModelInfo]:
+        return self._by_id.get(model_id)
+
     def get_models_by_type(self, capability: Type[BaseAIModel]) -> List[BaseAIModel]:
-        models = []
-        for provider_models in self._providers.values():
-            for model in provider_models.values():
-                if capability in model.meta.capabilities:
-                    models.append(model)
-        return models
+        return [self._resolve(meta.model_id) for meta in self._by_capability.get(capability, ())]
+
+    def get_model_infos_by_type(self, capability: Type[BaseAIModel]) -> List[ModelInfo]:
+        return list(self._by_capability.get(capability, ()))
 
     def get_default_model(self, provider: str) -> Optional[BaseAIModel]:
         models = self._providers.get(provider.lower(), {})
-        for model in models.values():
-            if model.meta.default:
-                return model
-        return next(iter(models.values()), None) if models else None
+        for meta in models.values():
+            if meta.default:
+                return self._resolve(meta.model_id)
+        return self._resolve(next(iter(models.values())).model_id) if models else None
 
     def get_providers(self) -> List[str]:
         return list(self._providers.keys())
 
     def get_providers_to_user(self) -> List[str]:
-        return list(provider for provider in self._providers.keys() if provider != "whisper")
+        return list(self._user_providers)
 
     def get_all_models(self) -> List[BaseAIModel]:
-        return [model for versions in self._providers.values() for model in versions.values()]
+        return [self._resolve(model_id) for model_id in self._by_id]
+
+    def get_all_model_infos(self) -> List[ModelInfo]:
+        return list(self._by_id.values())
 
     def get_models_for_provider(self, provider: str) -> List[BaseAIModel]:
+        return [self._resolve(meta.model_id) for meta in self._providers.get(provider.lower(), {}).values()]
+
+    def get_model_infos_for_provider(self, provider: str) -> List[ModelInfo]:
         return list(self._providers.get(provider.lower(), {}).values())
 
 
 def register_model():
     def decorator(cls):
-        instance = cls()
         registry = AIRegistry()
-        registry.add_model(instance)
+        registry.add_model_class(cls)
         return cls
 
     return decorator
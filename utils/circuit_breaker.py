@@ -0,0 +1,105 @@
+import os
+import time
+from collections import deque
+from typing import Dict
+
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_REQUESTS = int(os.getenv('BREAKER_MIN_REQUESTS', '5'))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', '60'))
+BREAKER_SLOW_CALL_RATE = float(os.getenv('BREAKER_SLOW_CALL_RATE', '0.8'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Размыкатель по скользящему окну последних вызовов: при высокой доле ошибок или медленных
+    ответов запросы сразу отклоняются на BREAKER_OPEN_SECONDS, затем пропускается один пробный запрос.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = STATE_CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN:
+            if time.monotonic() - self._opened_at < BREAKER_OPEN_SECONDS:
+                return False
+            self.state = STATE_HALF_OPEN
+            self._probe_in_flight = False
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def is_open(self) -> bool:
+        return self.state == STATE_OPEN and time.monotonic() - self._opened_at < BREAKER_OPEN_SECONDS
+
+    def record(self, success: bool, latency: float) -> None:
+        if self.state == STATE_HALF_OPEN:
+            self._probe_in_flight = False
+            if success:
+                print(f"Circuit {self.name} closed after successful probe")
+                self.state = STATE_CLOSED
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append((success, latency >= BREAKER_SLOW_CALL_SECONDS))
+        if len(self._outcomes) < BREAKER_MIN_REQUESTS:
+            return
+
+        failures = sum(1 for ok, _ in self._outcomes if not ok)
+        slow_calls = sum(1 for _, slow in self._outcomes if slow)
+        if (failures / len(self._outcomes) >= BREAKER_FAILURE_RATE
+                or slow_calls / len(self._outcomes) >= BREAKER_SLOW_CALL_RATE):
+            self._open()
+
+    def _open(self) -> None:
+        if self.state != STATE_OPEN:
+            print(f"Circuit {self.name} opened for {BREAKER_OPEN_SECONDS}s")
+        self.state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def health(self) -> float:
+        """
+        Оценка состояния модели от 0 до 1 по окну вызовов: ошибка считается целиком,
+        медленный ответ - наполовину. Открытый размыкатель - 0.
+        """
+        if self.is_open():
+            return 0.0
+        if not self._outcomes:
+            return 1.0
+        penalty = sum(1.0 if not ok else 0.5 if slow else 0.0 for ok, slow in self._outcomes)
+        return 1.0 - penalty / len(self._outcomes)
+
+    def snapshot(self) -> Dict:
+        failures = sum(1 for ok, _ in self._outcomes if not ok)
+        slow_calls = sum(1 for _, slow in self._outcomes if slow)
+        return {"state": self.state, "window": len(self._outcomes), "failures": failures, "slow_calls": slow_calls}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = CircuitBreaker(name)
+        _breakers[name] = breaker
+    return breaker
+
+
+def breakers_snapshot() -> Dict[str, Dict]:
+    return {name: breaker.snapshot() for name, breaker in _breakers.items()}
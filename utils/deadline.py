@@ -0,0 +1,28 @@
+import time
+from typing import Iterable
+
+
+class ModelTimeoutError(Exception):
+    """Модель не ответила до истечения дедлайна запроса."""
+
+
+class Deadline:
+    """
+    Момент времени, к которому запрос пользователя должен быть обработан.
+    Создается обработчиком и передается в execute_model, чтобы все вызовы укладывались в общий бюджет.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    @classmethod
+    def for_models(cls, models: Iterable, extra: float = 0.0) -> 'Deadline':
+        return cls(max(model.meta.timeout for model in models) + extra)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from database import DatabaseManager, _create_fsm_states_table
+
+# Сколько состояний держать в памяти; остальные читаются из БД при обращении.
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+# Изменения записываются в БД пачками: не реже раза в FSM_FLUSH_INTERVAL секунд
+# и сразу, как только изменится FSM_MAX_UNFLUSHED состояний.
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1'))
+FSM_MAX_UNFLUSHED = int(os.getenv('FSM_MAX_UNFLUSHED', '500'))
+# Состояние, которое не менялось и не читалось FSM_STATE_TTL секунд, забывается (0 - хранить всегда).
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', str(30 * 24 * 3600)))
+FSM_PURGE_INTERVAL = float(os.getenv('FSM_PURGE_INTERVAL', '3600'))
+# Чтение продлевает жизнь состояния не чаще раза в сутки, чтобы не писать в БД на каждое сообщение.
+FSM_TOUCH_INTERVAL = 24 * 3600
+
+
+@dataclass
+class _FSMRecord:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+def _select_fsm_record(conn: sqlite3.Connection, key: str) -> Optional[Tuple[Optional[str], str, float]]:
+    return conn.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)).fetchone()
+
+
+def _write_fsm_records(conn: sqlite3.Connection, upserts: List[Tuple[str, Optional[str], str, float]],
+                       deletes: List[Tuple[str]]) -> None:
+    conn.executemany("""
+        INSERT INTO fsm_states (key, state, data, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            state = excluded.state,
+            data = excluded.data,
+            updated_at = excluded.updated_at
+    """, upserts)
+    conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+
+
+def _purge_fsm_records(conn: sqlite3.Connection, expired_before: float) -> int:
+    return conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (expired_before,)).rowcount
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states. Недавно использованные состояния лежат в памяти (LRU
+    на FSM_CACHE_SIZE записей), изменения записываются в БД одной транзакцией в фоне, поэтому
+    обработчики не ждут диска. При остановке бота несохраненные изменения записываются,
+    при падении процесса теряется не больше FSM_FLUSH_INTERVAL секунд изменений.
+    """
+
+    def __init__(self, key_builder: Optional[KeyBuilder] = None) -> None:
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: "OrderedDict[StorageKey, _FSMRecord]" = OrderedDict()
+        # Измененные записи ждут записи в БД и не вытесняются из памяти, пока не будут сохранены.
+        self._dirty: Dict[StorageKey, _FSMRecord] = {}
+        self._flushing: Dict[StorageKey, _FSMRecord] = {}
+        self._loading: Dict[StorageKey, asyncio.Future] = {}
+        self._table_ready = False
+        self._flush_task = None
+        self._flush_requested = None
+        self._next_purge = time.monotonic()
+
+    async def _ensure_table(self) -> None:
+        if not self._table_ready:
+            await DatabaseManager().write(_create_fsm_states_table)
+            self._table_ready = True
+
+    @staticmethod
+    def _expired(record: _FSMRecord) -> bool:
+        return FSM_STATE_TTL > 0 and record.updated_at < time.time() - FSM_STATE_TTL
+
+    def _remember(self, key: StorageKey, record: _FSMRecord) -> None:
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > FSM_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _lookup(self, key: StorageKey) -> Optional[_FSMRecord]:
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+        record = self._dirty.get(key) or self._flushing.get(key)
+        if record is not None:
+            self._remember(key, record)
+        return record
+
+    async def _load(self, key: StorageKey) -> _FSMRecord:
+        await self._ensure_table()
+        row = await DatabaseManager().read(_select_fsm_record, self.key_builder.build(key))
+        if row is None:
+            return _FSMRecord()
+        state, data, updated_at = row
+        return _FSMRecord(state, json.loads(data), updated_at)
+
+    async def _get_record(self, key: StorageKey) -> _FSMRecord:
+        record = self._lookup(key)
+        if record is None:
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(key))
+                self._loading[key] = loading
+            try:
+                loaded = await asyncio.shield(loading)
+            finally:
+                self._loading.pop(key, None)
+            # Пока запись читалась, ее могли изменить: новое значение важнее прочитанного.
+            record = self._lookup(key)
+            if record is None:
+                record = loaded
+                self._remember(key, record)
+
+        if self._expired(record):
+            record.state = None
+            record.data = {}
+            self._mark_dirty(key, record)
+        elif time.time() - record.updated_at > FSM_TOUCH_INTERVAL:
+            self._mark_dirty(key, record)
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: _FSMRecord) -> None:
+        record.updated_at = time.time()
+        self._dirty[key] = record
+        self._ensure_flusher()
+        if len(self._dirty) >= FSM_MAX_UNFLUSHED:
+            self._flush_requested.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_record(key)).data.copy()
+
+    async def flush(self) -> None:
+        batch, self._dirty = self._dirty, {}
+        if batch:
+            upserts = []
+            deletes = []
+            for key, record in batch.items():
+                storage_key = self.key_builder.build(key)
+                if record.empty:
+                    # Пустое состояние (после state.clear()) не хранится.
+                    deletes.append((storage_key,))
+                    continue
+                try:
+                    upserts.append((storage_key, record.state, json.dumps(record.data, ensure_ascii=False),
+                                    record.updated_at))
+                except (TypeError, ValueError) as e:
+                    print(f"FSM data for {storage_key} is not JSON serializable, not saved: {e}")
+
+            self._flushing = batch
+            try:
+                await self._ensure_table()
+                await DatabaseManager().write(_write_fsm_records, upserts, deletes)
+            except (sqlite3.Error, asyncio.CancelledError) as e:
+                # Изменения возвращаются в очередь; повторная запись того же значения безвредна.
+                for key, record in batch.items():
+                    self._dirty.setdefault(key, record)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                print(f"Database error flushing FSM states: {e}")
+                return
+            finally:
+                self._flushing = {}
+
+        if FSM_STATE_TTL > 0 and time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + FSM_PURGE_INTERVAL
+            try:
+                await self._ensure_table()
+                purged = await DatabaseManager().write(_purge_fsm_records, time.time() - FSM_STATE_TTL)
+                if purged:
+                    print(f"Purged {purged} idle FSM state(s)")
+            except sqlite3.Error as e:
+                print(f"Database error purging FSM states: {e}")
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=FSM_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    def _ensure_flusher(self) -> None:
+        if self._flush_task is None:
+            self._flush_requested = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
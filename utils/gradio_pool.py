@@ -0,0 +1,172 @@
+import asyncio
+import os
+from typing import Dict, Any, Optional
+
+import aiohttp
+import httpx
+import gradio_client.exceptions
+
+from gradio_client import Client
+from gradio_client.utils import Status
+from registry import run_in_provider_executor, get_provider_executor
+from utils.http import get_http_session
+from utils.progress import JobProgress, report_progress
+
+GRADIO_HEALTH_CHECK_TIMEOUT = float(os.getenv('GRADIO_HEALTH_CHECK_TIMEOUT', '10'))
+GRADIO_JOB_POLL_INTERVAL = float(os.getenv('GRADIO_JOB_POLL_INTERVAL', '0.5'))
+# 0 - периодический keep-warm пинг отключен.
+GRADIO_KEEP_WARM_INTERVAL = float(os.getenv('GRADIO_KEEP_WARM_INTERVAL', '0'))
+
+# Ошибки соединения, после которых клиент пересоздается и запрос повторяется один раз.
+RECONNECT_ERRORS = (httpx.TransportError, ConnectionError, aiohttp.ClientConnectionError)
+
+
+def _job_progress(status) -> Optional[JobProgress]:
+    if status.code == Status.IN_QUEUE:
+        return JobProgress("queue", rank=status.rank, queue_size=status.queue_size, eta=status.eta)
+    if status.code in (Status.PROCESSING, Status.PROGRESS, Status.ITERATING):
+        fraction = None
+        if status.progress_data:
+            unit = status.progress_data[-1]
+            if unit.progress is not None:
+                fraction = unit.progress
+            elif unit.index is not None and unit.length:
+                fraction = unit.index / unit.length
+        return JobProgress("processing", eta=status.eta, fraction=fraction)
+    return None
+
+
+class GradioClientPool:
+    """
+    Пул gradio_client.Client по space id: клиент создается при первом обращении,
+    переиспользуется между запросами и пересоздается после сбоя соединения.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._clients = {}
+            cls._instance._spaces = {}
+            cls._instance._locks = {}
+            cls._instance._keep_warm_task = None
+        return cls._instance
+
+    def register_space(self, space_id: str, provider: str, **client_kwargs) -> None:
+        """
+        Запоминает провайдера (для пула потоков) и параметры создания клиента. Сеть не используется.
+        """
+        self._spaces.setdefault(space_id, {"provider": provider, "client_kwargs": client_kwargs})
+
+    def _get_space(self, space_id: str) -> Dict[str, Any]:
+        if space_id not in self._spaces:
+            raise KeyError(f"Gradio space {space_id} is not registered in the pool")
+        return self._spaces[space_id]
+
+    async def get_client(self, space_id: str) -> Client:
+        client = self._clients.get(space_id)
+        if client is not None:
+            return client
+
+        lock = self._locks.setdefault(space_id, asyncio.Lock())
+        async with lock:
+            client = self._clients.get(space_id)
+            if client is None:
+                space = self._get_space(space_id)
+                print(f"Connecting to Gradio space {space_id}...")
+                client = await run_in_provider_executor(
+                    space["provider"], Client, space_id, **space["client_kwargs"]
+                )
+                self._clients[space_id] = client
+        return client
+
+    def invalidate(self, space_id: str) -> None:
+        if self._clients.pop(space_id, None) is not None:
+            print(f"Gradio client for {space_id} dropped, it will be recreated on next request")
+
+    async def _run_job(self, space_id: str, client: Client, args, kwargs):
+        """
+        Запускает задачу через client.submit() и ждет ее завершения, не занимая поток.
+        Место в очереди и прогресс задачи передаются обработчику через report_progress.
+        При отмене корутины (дедлайн, хеджирование) задача отменяется и в самом Space.
+        """
+        provider = self._get_space(space_id)["provider"]
+        job = await run_in_provider_executor(provider, client.submit, *args, **kwargs)
+        last_progress = None
+        try:
+            while not job.done():
+                # job.status() читает последнее состояние, полученное клиентом, и не ходит в сеть.
+                progress = _job_progress(job.status())
+                if progress is not None and progress != last_progress:
+                    last_progress = progress
+                    await report_progress(progress)
+                await asyncio.sleep(GRADIO_JOB_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            print(f"Cancelling Gradio job on {space_id}")
+            get_provider_executor(provider).submit(job.cancel)
+            raise
+        return job.result()
+
+    async def predict(self, space_id: str, *args, **kwargs):
+        client = await self.get_client(space_id)
+        try:
+            return await self._run_job(space_id, client, args, kwargs)
+        except gradio_client.exceptions.AppError:
+            raise
+        except RECONNECT_ERRORS as e:
+            print(f"Connection to Gradio space {space_id} failed: {e}. Reconnecting...")
+            self.invalidate(space_id)
+            client = await self.get_client(space_id)
+            return await self._run_job(space_id, client, args, kwargs)
+        except Exception:
+            self.invalidate(space_id)
+            raise
+
+    async def check_health(self, space_id: str) -> bool:
+        """
+        Проверяет, что Space отвечает на запрос конфигурации. Неотвечающий клиент удаляется из пула.
+        """
+        client = self._clients.get(space_id)
+        if client is None:
+            try:
+                await self.get_client(space_id)
+                return True
+            except Exception as e:
+                print(f"Gradio space {space_id} is unavailable: {e}")
+                return False
+
+        config_url = f"{client.src.rstrip('/')}/config"
+        try:
+            session = get_http_session()
+            async with session.get(config_url, timeout=aiohttp.ClientTimeout(total=GRADIO_HEALTH_CHECK_TIMEOUT)) as response:
+                healthy = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Health check for Gradio space {space_id} failed: {e}")
+            healthy = False
+
+        if not healthy:
+            self.invalidate(space_id)
+        return healthy
+
+    async def _keep_warm_loop(self, interval: float) -> None:
+        while True:
+            for space_id in list(self._spaces):
+                healthy = await self.check_health(space_id)
+                print(f"Keep-warm ping for {space_id}: {'ok' if healthy else 'failed'}")
+            await asyncio.sleep(interval)
+
+    def start_keep_warm(self, interval: float = GRADIO_KEEP_WARM_INTERVAL) -> None:
+        if interval <= 0 or self._keep_warm_task is not None:
+            return
+        self._keep_warm_task = asyncio.create_task(self._keep_warm_loop(interval))
+        print(f"Gradio keep-warm started, interval {interval}s")
+
+    async def stop_keep_warm(self) -> None:
+        if self._keep_warm_task is None:
+            return
+        self._keep_warm_task.cancel()
+        try:
+            await self._keep_warm_task
+        except asyncio.CancelledError:
+            pass
+        self._keep_warm_task = None
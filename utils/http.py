@@ -0,0 +1,48 @@
+import os
+from io import BytesIO
+from typing import Optional
+
+import aiohttp
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+HTTP_POOL_SIZE_PER_HOST = int(os.getenv('HTTP_POOL_SIZE_PER_HOST', '20'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Общая для всего бота HTTP-сессия с пулом keep-alive соединений.
+    Должна вызываться из работающего event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        )
+    return _session
+
+
+async def download_bytes(url: str) -> BytesIO:
+    session = get_http_session()
+    async with session.get(url) as response:
+        response.raise_for_status()
+        data = BytesIO(await response.read())
+    data.seek(0)
+    return data
+
+
+async def close_http_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        print("Shared HTTP session closed")
+    _session = None
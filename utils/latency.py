@@ -0,0 +1,80 @@
+import bisect
+import math
+from collections import deque
+from typing import Dict, Optional
+
+# Верхние границы корзин гистограммы в секундах.
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, math.inf)
+LATENCY_WINDOW = 200
+
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек: накопительные счетчики по корзинам для мониторинга
+    и скользящее окно последних значений для расчета перцентилей.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        # Пары (секунды, censored): censored - запрос отменили или он упал, настоящая задержка не меньше.
+        self._recent = deque(maxlen=window)
+        self._buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.censored = 0
+
+    def observe(self, seconds: float, censored: bool = False) -> None:
+        self._recent.append((seconds, censored))
+        if censored:
+            self.censored += 1
+            return
+        self._buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Перцентиль по оценке Каплана-Мейера: цензурированное значение не считается задержкой,
+        но учитывает, что запрос длился дольше. Если доля q не достигается на завершенных
+        запросах, возвращается наибольшее значение окна (оценка снизу).
+        """
+        if not self._recent:
+            return None
+        values = sorted(self._recent)
+        at_risk = len(values)
+        survival = 1.0
+        for seconds, censored in values:
+            if not censored:
+                survival *= 1 - 1 / at_risk
+                if 1 - survival >= q - 1e-9:
+                    return seconds
+            at_risk -= 1
+        return values[-1][0]
+
+    def sample_size(self) -> int:
+        return len(self._recent)
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "censored": self.censored,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "buckets": {("+Inf" if math.isinf(bound) else bound): hits
+                        for bound, hits in zip(LATENCY_BUCKETS, self._buckets)},
+        }
+
+
+_histograms: Dict[str, LatencyHistogram] = {}
+
+
+def get_latency_histogram(name: str) -> LatencyHistogram:
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = LatencyHistogram()
+        _histograms[name] = histogram
+    return histogram
+
+
+def latency_snapshot() -> Dict[str, Dict]:
+    return {name: histogram.snapshot() for name, histogram in _histograms.items()}
@@ -0,0 +1,70 @@
+import os
+import random
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+# 0 - пары для арены выбираются равномерно, как раньше.
+MATCHMAKING_ENABLED = os.getenv('MATCHMAKING_ENABLED', '1') == '1'
+# Неопределенность рейтинга модели без голосов (в очках Elo), с каждым голосом дисперсия уменьшается.
+MATCHMAKING_INITIAL_SIGMA = float(os.getenv('MATCHMAKING_INITIAL_SIGMA', '350'))
+# Доля пар, выбираемых равномерно: новые и давно не встречавшиеся пары тоже получают голоса.
+MATCHMAKING_EXPLORATION = float(os.getenv('MATCHMAKING_EXPLORATION', '0.1'))
+# Модели с меньшей долей успешных ответов (по размыкателю) в арену не попадают.
+MATCHMAKING_MIN_HEALTH = float(os.getenv('MATCHMAKING_MIN_HEALTH', '0.5'))
+
+
+@dataclass
+class MatchCandidate:
+    model_id: str
+    rating: float = 1000
+    votes: int = 0
+    # Доля успешных ответов модели в последнее время, от 0 до 1.
+    health: float = 1.0
+
+    @property
+    def variance(self) -> float:
+        return MATCHMAKING_INITIAL_SIGMA ** 2 / (1 + self.votes)
+
+
+def expected_score(rating_a: float, rating_b: float) -> float:
+    return 1 / (1 + 10 ** ((rating_b - rating_a) / 400))
+
+
+def pair_weight(a: MatchCandidate, b: MatchCandidate) -> float:
+    """
+    Ожидаемая польза голоса за пару: исход неизвестен, когда рейтинги близки (p(1-p) максимально
+    при p=0.5), и голос сильнее уточняет рейтинги, в которых мы меньше уверены.
+    Нездоровые модели выбираются реже, чтобы голос не пропал из-за ошибки.
+    """
+    p = expected_score(a.rating, b.rating)
+    return p * (1 - p) * (a.variance + b.variance) * a.health * b.health
+
+
+def choose_pair(candidates: Sequence[MatchCandidate], exploration: float = MATCHMAKING_EXPLORATION,
+                rng: Optional[random.Random] = None) -> Tuple[MatchCandidate, MatchCandidate]:
+    """
+    Выбирает пару для арены с вероятностью, пропорциональной pair_weight.
+    Порядок моделей в паре случаен, чтобы позиция ответа не влияла на рейтинг.
+    """
+    rng = rng or random
+    if len(candidates) < 2:
+        raise ValueError("At least two candidates are required to choose a pair")
+
+    healthy = [candidate for candidate in candidates if candidate.health >= MATCHMAKING_MIN_HEALTH]
+    if len(healthy) >= 2:
+        candidates = healthy
+
+    if rng.random() < exploration:
+        pair = rng.sample(list(candidates), 2)
+    else:
+        pairs: List[Tuple[MatchCandidate, MatchCandidate]] = [
+            (a, b) for i, a in enumerate(candidates) for b in candidates[i + 1:]
+        ]
+        weights = [pair_weight(a, b) for a, b in pairs]
+        if sum(weights) > 0:
+            pair = list(rng.choices(pairs, weights=weights)[0])
+        else:
+            pair = rng.sample(list(candidates), 2)
+
+    rng.shuffle(pair)
+    return pair[0], pair[1]
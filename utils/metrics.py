@@ -0,0 +1,51 @@
+import asyncio
+import json
+import os
+from typing import Dict, Optional
+
+from ai.flux import hedge_delays
+from execution import execution_stats
+from utils.circuit_breaker import breakers_snapshot
+from utils.latency import latency_snapshot
+from utils.response_cache import ResponseCache
+
+# Как часто сводка метрик выводится в лог, в секундах (0 - не выводится).
+# В режиме webhook та же сводка доступна по адресу /metrics.
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '300'))
+
+_log_task: Optional[asyncio.Task] = None
+
+
+def metrics_snapshot() -> Dict:
+    return {
+        "execution": execution_stats(),
+        "breakers": breakers_snapshot(),
+        "response_cache": ResponseCache().stats(),
+        "latency": latency_snapshot(),
+        "flux_hedge_delay": hedge_delays(),
+    }
+
+
+async def _log_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print(f"Metrics: {json.dumps(metrics_snapshot(), ensure_ascii=False)}")
+
+
+def start_metrics_logging(interval: float = METRICS_LOG_INTERVAL) -> None:
+    global _log_task
+    if interval <= 0 or _log_task is not None:
+        return
+    _log_task = asyncio.create_task(_log_loop(interval))
+
+
+async def stop_metrics_logging() -> None:
+    global _log_task
+    if _log_task is None:
+        return
+    _log_task.cancel()
+    try:
+        await _log_task
+    except asyncio.CancelledError:
+        pass
+    _log_task = None
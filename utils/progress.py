@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+
+@dataclass(frozen=True)
+class JobProgress:
+    """Состояние задачи в Gradio Space: 'queue' - ждет в очереди, 'processing' - выполняется."""
+    stage: str
+    rank: Optional[int] = None
+    queue_size: Optional[int] = None
+    eta: Optional[float] = None
+    # Доля выполненной работы от 0 до 1, если Space ее сообщает.
+    fraction: Optional[float] = None
+
+
+ProgressCallback = Callable[[JobProgress], Awaitable[None]]
+
+# Обработчик, который показывает прогресс текущего запроса пользователю.
+# Контекст копируется в задачи asyncio, поэтому колбэк доходит до пула Gradio без явной передачи.
+_progress_callback: ContextVar[Optional[ProgressCallback]] = ContextVar("progress_callback", default=None)
+
+
+@contextmanager
+def progress_reporter(callback: ProgressCallback):
+    token = _progress_callback.set(callback)
+    try:
+        yield
+    finally:
+        _progress_callback.reset(token)
+
+
+def current_progress_callback() -> Optional[ProgressCallback]:
+    return _progress_callback.get()
+
+
+async def report_progress(progress: JobProgress) -> None:
+    callback = _progress_callback.get()
+    if callback is None:
+        return
+    try:
+        await callback(progress)
+    except Exception as e:
+        print(f"Error reporting job progress: {e}")
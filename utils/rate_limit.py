@@ -0,0 +1,206 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Union
+
+# Значения по умолчанию для провайдеров, 0 - без ограничения.
+# Переопределяются переменными RATE_LIMIT_<PROVIDER>_RPM / _TPM / _CONCURRENCY.
+# Groq и Gemini считают RPM и TPM для каждой модели отдельно, поэтому корзины rpm/tpm заводятся
+# на каждую модель провайдера, а concurrency - общий предел одновременных запросов к провайдеру.
+PROVIDER_LIMIT_DEFAULTS = {
+    "llama": {"rpm": 30, "tpm": 6000, "concurrency": 8},
+    "gemini": {"rpm": 15, "tpm": 1000000, "concurrency": 8},
+    "flux": {"rpm": 0, "tpm": 0, "concurrency": 4},
+    "midjourney": {"rpm": 0, "tpm": 0, "concurrency": 4},
+    "whisper": {"rpm": 0, "tpm": 0, "concurrency": 4},
+}
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '10'))
+# Провайдеры на Gradio Spaces и так ставят задачи в очередь и показывают позицию в ней,
+# поэтому запрос к ним ждет свободного места до дедлайна запроса, а не RATE_LIMIT_MAX_WAIT.
+QUEUED_PROVIDERS = ("flux", "midjourney", "whisper")
+RATE_LIMIT_DEFAULT_BACKOFF = float(os.getenv('RATE_LIMIT_DEFAULT_BACKOFF', '5'))
+ESTIMATED_OUTPUT_TOKENS = int(os.getenv('ESTIMATED_OUTPUT_TOKENS', '512'))
+# AIMD: при 429 скорость уменьшается вдвое, после успешных ответов постепенно возвращается к настроенной.
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_STEP = 0.05
+MIN_RATE_FRACTION = 0.1
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.max_rate = per_minute / 60
+        self.rate = self.max_rate
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+
+class ProviderAdmissionController:
+    """
+    Ограничивает обращения к модели провайдера: корзины токенов на запросы и оценку токенов в минуту
+    плюс семафор одновременных запросов, общий для всех моделей провайдера.
+    Запрос ждет своей очереди до дедлайна, а не падает сразу.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int, semaphore: Optional[asyncio.Semaphore]):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.semaphore = semaphore
+        self._blocked_until = 0.0
+
+    def _wait_time(self, estimated_tokens: int) -> float:
+        waits = [self._blocked_until - time.monotonic()]
+        if self.requests:
+            waits.append(self.requests.wait_time(1))
+        if self.tokens:
+            waits.append(self.tokens.wait_time(estimated_tokens))
+        return max(waits)
+
+    async def acquire(self, estimated_tokens: int, max_wait: float = RATE_LIMIT_MAX_WAIT) -> None:
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._wait_time(estimated_tokens)
+            if wait <= 0:
+                break
+            if time.monotonic() + wait > deadline:
+                raise AdmissionTimeout(f"Rate limit for {self.name}: no capacity within {max_wait}s")
+            await asyncio.sleep(wait)
+
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(estimated_tokens)
+
+        if self.semaphore:
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                # Запрос так и не был отправлен: списанное с корзин возвращается.
+                if self.requests:
+                    self.requests.refund(1)
+                if self.tokens:
+                    self.tokens.refund(estimated_tokens)
+                raise AdmissionTimeout(f"Too many requests in flight for {self.name}")
+
+    async def try_acquire(self, estimated_tokens: int = 0) -> bool:
+        """Занимает место без ожидания, для необязательных запросов (например, хеджирования)."""
+        if self._wait_time(estimated_tokens) > 0 or (self.semaphore and self.semaphore.locked()):
+            return False
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(estimated_tokens)
+        if self.semaphore:
+            # Семафор свободен, поэтому acquire() не уступает управление.
+            await self.semaphore.acquire()
+        return True
+
+    def release(self) -> None:
+        if self.semaphore:
+            self.semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self, estimated_tokens: int = 0, max_wait: float = RATE_LIMIT_MAX_WAIT):
+        await self.acquire(estimated_tokens, max_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def penalize(self, retry_after: Union[str, float, None] = None) -> None:
+        """
+        Вызывается моделью при ответе 429: приостанавливает запросы на Retry-After и снижает скорость.
+        """
+        try:
+            delay = float(retry_after) if retry_after is not None else RATE_LIMIT_DEFAULT_BACKOFF
+        except ValueError:
+            delay = RATE_LIMIT_DEFAULT_BACKOFF
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.rate = max(bucket.max_rate * MIN_RATE_FRACTION, bucket.rate * RATE_DECREASE_FACTOR)
+                bucket.tokens = min(bucket.tokens, 0)
+        print(f"{self.name} rate limited, pausing for {delay}s")
+
+    def on_success(self) -> None:
+        for bucket in (self.requests, self.tokens):
+            if bucket and bucket.rate < bucket.max_rate:
+                bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * RATE_INCREASE_STEP)
+
+
+_controllers: Dict[str, ProviderAdmissionController] = {}
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _limit(provider: str, name: str) -> int:
+    raw_value = os.getenv(f"RATE_LIMIT_{provider.upper()}_{name.upper()}")
+    if raw_value:
+        try:
+            return int(raw_value)
+        except ValueError:
+            print(f"Invalid rate limit '{raw_value}' for provider {provider}, using default.")
+    return PROVIDER_LIMIT_DEFAULTS.get(provider, {}).get(name, 0)
+
+
+def _provider_semaphore(provider: str) -> Optional[asyncio.Semaphore]:
+    semaphore = _semaphores.get(provider)
+    if semaphore is None:
+        concurrency = _limit(provider, "concurrency")
+        if concurrency <= 0:
+            return None
+        semaphore = asyncio.Semaphore(concurrency)
+        _semaphores[provider] = semaphore
+    return semaphore
+
+
+def get_admission_controller(provider: str, model_id: Optional[str] = None) -> ProviderAdmissionController:
+    """Контроллер модели model_id (или всего провайдера, если модель не указана)."""
+    provider = provider.lower()
+    name = model_id or provider
+    controller = _controllers.get(name)
+    if controller is None:
+        controller = ProviderAdmissionController(
+            name,
+            rpm=_limit(provider, "rpm"),
+            tpm=_limit(provider, "tpm"),
+            semaphore=_provider_semaphore(provider)
+        )
+        _controllers[name] = controller
+    return controller
+
+
+def admission_wait(provider: str, remaining: float) -> float:
+    """Сколько запрос к провайдеру может ждать своей очереди, если до дедлайна осталось remaining секунд."""
+    if provider.lower() in QUEUED_PROVIDERS:
+        return remaining
+    return min(RATE_LIMIT_MAX_WAIT, remaining)
+
+
+def estimate_tokens(*inputs, output_tokens: Optional[int] = None) -> int:
+    # Грубая оценка: ~4 символа на токен для текста плюс бюджет на ответ.
+    text_length = sum(len(value) for value in inputs if isinstance(value, str))
+    return text_length // 4 + 1 + (ESTIMATED_OUTPUT_TOKENS if output_tokens is None else output_tokens)
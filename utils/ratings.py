@@ -0,0 +1,150 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+INITIAL_RATING = 1000
+ELO_K_FACTOR = 32
+# Шкала Bradley–Terry переводится в рейтинг Elo: разница в 400 очков - шансы 10:1.
+ELO_SCALE = 400
+BT_MAX_ITERATIONS = 1000
+BT_TOLERANCE = 1e-8
+# Виртуальная ничья в каждой сыгранной паре, чтобы модель без побед не получала рейтинг -inf.
+BT_PRIOR = 1.0
+
+OUTCOME_SCORES = {"a": 1.0, "b": 0.0, "tie": 0.5}
+
+
+@dataclass
+class VoteArrays:
+    """История голосов в виде массивов индексов моделей и очков первой модели пары."""
+    model_ids: List[str]
+    model_a: np.ndarray
+    model_b: np.ndarray
+    score_a: np.ndarray
+
+    @property
+    def size(self) -> int:
+        return len(self.score_a)
+
+
+def build_vote_arrays(votes: Sequence[Tuple[str, str, str]]) -> VoteArrays:
+    model_ids = sorted({model_id for model_a, model_b, _ in votes for model_id in (model_a, model_b)})
+    index = {model_id: i for i, model_id in enumerate(model_ids)}
+    return VoteArrays(
+        model_ids=model_ids,
+        model_a=np.fromiter((index[vote[0]] for vote in votes), dtype=np.int32, count=len(votes)),
+        model_b=np.fromiter((index[vote[1]] for vote in votes), dtype=np.int32, count=len(votes)),
+        score_a=np.fromiter((OUTCOME_SCORES[vote[2]] for vote in votes), dtype=np.float64, count=len(votes)),
+    )
+
+
+def elo_replay(model_a: np.ndarray, model_b: np.ndarray, score_a: np.ndarray, n_models: int,
+               k_factor: float = ELO_K_FACTOR, initial: float = INITIAL_RATING) -> np.ndarray:
+    """
+    Последовательно применяет голоса, как calculate_elo_update, но без округления.
+    Каждый голос зависит от рейтингов после предыдущего, поэтому цикл не векторизуется;
+    шаг numpy дороже самой арифметики, и цикл идет по спискам Python.
+    """
+    ratings = [float(initial)] * n_models
+    for a, b, score in zip(model_a.tolist(), model_b.tolist(), score_a.tolist()):
+        expected_a = 1.0 / (1.0 + 10.0 ** ((ratings[b] - ratings[a]) / ELO_SCALE))
+        delta = k_factor * (score - expected_a)
+        ratings[a] += delta
+        ratings[b] -= delta
+    return np.array(ratings)
+
+
+def bradley_terry(model_a: np.ndarray, model_b: np.ndarray, score_a: np.ndarray, n_models: int,
+                  prior: float = BT_PRIOR) -> np.ndarray:
+    """
+    Оценка максимального правдоподобия модели Bradley–Terry (MM-алгоритм Хантера),
+    ничья считается половиной победы каждой стороны. Результат не зависит от порядка голосов
+    и приведен к шкале Elo со средним INITIAL_RATING.
+    """
+    wins = np.zeros((n_models, n_models))
+    np.add.at(wins, (model_a, model_b), score_a)
+    np.add.at(wins, (model_b, model_a), 1.0 - score_a)
+
+    games = wins + wins.T
+    played = games > 0
+    wins += prior / 2 * played
+    games += prior * played
+
+    total_wins = wins.sum(axis=1)
+    strengths = np.ones(n_models)
+    for _ in range(BT_MAX_ITERATIONS):
+        pair_sums = strengths[:, None] + strengths[None, :]
+        denominator = (games / pair_sums).sum(axis=1)
+        updated = np.divide(total_wins, denominator, out=np.ones(n_models), where=denominator > 0)
+        updated /= np.exp(np.log(updated).mean())
+        converged = np.max(np.abs(updated - strengths)) < BT_TOLERANCE
+        strengths = updated
+        if converged:
+            break
+
+    log_strengths = np.log10(strengths)
+    return INITIAL_RATING + ELO_SCALE * (log_strengths - log_strengths.mean())
+
+
+def _resample(votes: VoteArrays, rng: np.random.Generator, rounds: int) -> Tuple[np.ndarray, ...]:
+    # Голоса выбираются с возвращением; для Elo порядок выборки тоже случаен.
+    picks = rng.integers(0, votes.size, size=(rounds, votes.size), dtype=np.int32)
+    return votes.model_a[picks], votes.model_b[picks], votes.score_a[picks]
+
+
+def _bootstrap_chunk(votes: VoteArrays, method: str, rounds: int, seed: np.random.SeedSequence) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    n_models = len(votes.model_ids)
+    fit = elo_replay if method == "elo" else bradley_terry
+    results = []
+    for _ in range(rounds):
+        model_a, model_b, score_a = _resample(votes, rng, 1)
+        results.append(fit(model_a[0], model_b[0], score_a[0], n_models))
+    return np.stack(results)
+
+
+def fit_ratings(votes: VoteArrays, method: str = "bt") -> np.ndarray:
+    n_models = len(votes.model_ids)
+    if method == "elo":
+        return elo_replay(votes.model_a, votes.model_b, votes.score_a, n_models)
+    if method == "bt":
+        return bradley_terry(votes.model_a, votes.model_b, votes.score_a, n_models)
+    raise ValueError(f"Unknown rating method: {method}")
+
+
+def bootstrap_intervals(votes: VoteArrays, method: str = "bt", rounds: int = 200, confidence: float = 0.95,
+                        workers: Optional[int] = None, seed: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Доверительные интервалы рейтингов по бутстрепу голосов. Раунды делятся на части,
+    которые считаются в отдельных процессах. Возвращает нижние и верхние границы.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = [len(chunk) for chunk in np.array_split(np.arange(rounds), min(workers, rounds)) if len(chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    if len(chunks) == 1:
+        samples = _bootstrap_chunk(votes, method, chunks[0], seeds[0])
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [executor.submit(_bootstrap_chunk, votes, method, size, chunk_seed)
+                       for size, chunk_seed in zip(chunks, seeds)]
+            samples = np.concatenate([future.result() for future in futures])
+
+    tail = (1 - confidence) / 2 * 100
+    return np.percentile(samples, tail, axis=0), np.percentile(samples, 100 - tail, axis=0)
+
+
+def ratings_table(votes: VoteArrays, ratings: np.ndarray, lower: Optional[np.ndarray] = None,
+                  upper: Optional[np.ndarray] = None) -> List[Dict[str, object]]:
+    games = np.bincount(np.concatenate([votes.model_a, votes.model_b]), minlength=len(votes.model_ids))
+    rows = []
+    for i, model_id in enumerate(votes.model_ids):
+        row = {"model_id": model_id, "rating": float(ratings[i]), "votes": int(games[i])}
+        if lower is not None and upper is not None:
+            row["lower"] = float(lower[i])
+            row["upper"] = float(upper[i])
+        rows.append(row)
+    return sorted(rows, key=lambda row: row["rating"], reverse=True)
@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict, defaultdict
+from io import BytesIO
+from typing import Any, Dict, Tuple, Union
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '2000'))
+RESPONSE_CACHE_MAX_DISK_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_DISK_ENTRIES', '300'))
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR', os.path.join('.cache', 'responses'))
+
+
+def _normalize(value: Any) -> str:
+    if isinstance(value, str):
+        return "s:" + " ".join(value.split()).casefold()
+    if isinstance(value, BytesIO):
+        return "b:" + hashlib.sha256(value.getvalue()).hexdigest()
+    if isinstance(value, (bytes, bytearray)):
+        return "b:" + hashlib.sha256(value).hexdigest()
+    return "r:" + repr(value)
+
+
+def make_request_key(model_id: str, args: Tuple, kwargs: Dict[str, Any]) -> str:
+    """
+    Ключ запроса: id модели + нормализованный ввод (текст без лишних пробелов и регистра,
+    для изображений и аудио - хэш байтов).
+    """
+    parts = [model_id]
+    parts.extend(_normalize(arg) for arg in args)
+    parts.extend(f"{name}={_normalize(value)}" for name, value in sorted(kwargs.items()))
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов моделей с TTL и LRU-вытеснением.
+    Текст хранится в памяти, изображения (BytesIO) - на диске, в памяти остается только путь к файлу.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._memory = OrderedDict()
+            cls._instance._disk = None
+            cls._instance._stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+        return cls._instance
+
+    def _disk_index(self) -> OrderedDict:
+        # Индекс файлов восстанавливается из имен вида <key>_<expires_at>.img при первом обращении.
+        if self._disk is None:
+            self._disk = OrderedDict()
+            os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+            entries = []
+            for file_name in os.listdir(RESPONSE_CACHE_DIR):
+                name, ext = os.path.splitext(file_name)
+                key, _, expires_at = name.rpartition("_")
+                if ext != ".img" or not key:
+                    continue
+                try:
+                    entries.append((float(expires_at), key, os.path.join(RESPONSE_CACHE_DIR, file_name)))
+                except ValueError:
+                    continue
+            for expires_at, key, path in sorted(entries):
+                self._disk[key] = (expires_at, path)
+        return self._disk
+
+    async def get(self, model_id: str, key: str) -> Union[str, BytesIO, None]:
+        now = time.time()
+        stats = self._stats[model_id]
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                stats["hits"] += 1
+                return value
+            del self._memory[key]
+
+        disk = self._disk_index()
+        entry = disk.get(key)
+        if entry is not None:
+            expires_at, path = entry
+            if expires_at > now:
+                try:
+                    data = await asyncio.to_thread(_read_file, path)
+                    disk.move_to_end(key)
+                    stats["hits"] += 1
+                    return BytesIO(data)
+                except OSError as e:
+                    print(f"Response cache: failed to read {path}: {e}")
+            self._drop_disk_entry(key)
+
+        stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, response: Union[str, BytesIO, None], ttl: int) -> None:
+        if ttl <= 0 or not response:
+            return
+        expires_at = time.time() + ttl
+
+        if isinstance(response, str):
+            self._memory[key] = (expires_at, response)
+            self._memory.move_to_end(key)
+            while len(self._memory) > RESPONSE_CACHE_MAX_ENTRIES:
+                self._memory.popitem(last=False)
+            return
+
+        if isinstance(response, BytesIO):
+            disk = self._disk_index()
+            self._drop_disk_entry(key)
+            path = os.path.join(RESPONSE_CACHE_DIR, f"{key}_{expires_at:.0f}.img")
+            try:
+                await asyncio.to_thread(_write_file, path, response.getvalue())
+            except OSError as e:
+                print(f"Response cache: failed to write {path}: {e}")
+                return
+            disk[key] = (expires_at, path)
+            while len(disk) > RESPONSE_CACHE_MAX_DISK_ENTRIES:
+                self._drop_disk_entry(next(iter(disk)))
+
+    def _drop_disk_entry(self, key: str) -> None:
+        entry = self._disk_index().pop(key, None)
+        if entry is None:
+            return
+        try:
+            os.remove(entry[1])
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {model_id: dict(counters) for model_id, counters in self._stats.items()}
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as file:
+        file.write(data)
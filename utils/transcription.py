@@ -1,18 +1,26 @@
 import os
 import tempfile
 from io import BytesIO
+from typing import Optional
 from aiogram import types
+from execution import execute_model
 from registry import AIRegistry, AudioToTextModel
+from utils.deadline import Deadline, ModelTimeoutError
 
 
-async def transcribe_voice_message(message: types.Message, registry: AIRegistry) -> str | None:
+async def transcribe_voice_message(message: types.Message, registry: AIRegistry,
+                                   deadline: Optional[Deadline] = None) -> str | None:
+    """
+    Расшифровывает голосовое сообщение моделью Whisper. Расшифровка входит в дедлайн запроса
+    пользователя: если он истек, выбрасывается ModelTimeoutError.
+    """
     voice = message.voice
     if not voice:
         print("Error in transcribe_voice_message: message has no voice object.")
         return None
 
     try:
-        whisper_model = registry.get_model("whisper", "whisper-large-v3")
+        whisper_model = registry.get_model_by_id("whisper:whisper-large-v3")
         if not whisper_model:
             print("Transcription error: Whisper model 'whisper:whisper-large-v3' not found in registry.")
             return None
@@ -32,7 +40,7 @@ async def transcribe_voice_message(message: types.Message, registry: AIRegistry)
             temp_audio_path = temp_audio_file.name
 
         try:
-            transcription_result = await whisper_model.execute(temp_audio_path)
+            transcription_result = await execute_model(whisper_model, temp_audio_path, deadline=deadline)
 
             if isinstance(transcription_result, str):
                 transcription = transcription_result.strip()
@@ -40,6 +48,8 @@ async def transcribe_voice_message(message: types.Message, registry: AIRegistry)
                 print(f"Transcription error: Expected string response from Whisper, got {type(transcription_result)}")
                 transcription = None
 
+        except ModelTimeoutError:
+            raise
         except Exception as e:
             print(f"Transcription model execution failed: {e}")
             transcription = None
@@ -53,6 +63,8 @@ async def transcribe_voice_message(message: types.Message, registry: AIRegistry)
 
         return transcription
 
+    except ModelTimeoutError:
+        raise
     except Exception as e:
         print(f"Unexpected error in transcribe_voice_message process: {e}")
         return None
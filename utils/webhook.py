@@ -0,0 +1,132 @@
+import asyncio
+import os
+import signal
+from typing import Any, Dict, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from utils.metrics import metrics_snapshot
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Публичный адрес, по которому Telegram доставляет обновления (например, адрес балансировщика).
+# Если задан, каждый экземпляр при запуске регистрирует вебхук; если нет - он зарегистрирован заранее.
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')
+# Сколько обновлений один экземпляр обрабатывает одновременно. Когда все заняты, ответ
+# на запрос Telegram задерживается, и новые обновления ждут в очереди Telegram, а не в памяти.
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '100'))
+# Сколько одновременных соединений Telegram открывает к вебхуку (1-100).
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Сколько секунд при остановке ждать обработки уже принятых обновлений.
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv('WEBHOOK_SHUTDOWN_TIMEOUT', '30'))
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Принимает обновления от Telegram и обрабатывает их в фоне, не больше max_concurrency
+    одновременно. При остановке дожидается уже принятых обновлений, чтобы они не потерялись:
+    Telegram не пришлет повторно обновление, на которое получил ответ 200.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str,
+                 max_concurrency: int = WEBHOOK_MAX_CONCURRENCY, **data: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token, **data)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Свой вариант handle на публичном API aiogram: обновление обрабатывается в фоне,
+        # но ответ 200 отдается только после того, как для него освободился слот.
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process_update(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def _process_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        finally:
+            self._semaphore.release()
+
+    async def close(self) -> None:
+        tasks = set(self._tasks)
+        if tasks:
+            print(f"Waiting for {len(tasks)} webhook update(s) to finish...")
+            _, pending = await asyncio.wait(tasks, timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        await super().close()
+
+
+async def _health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.json_response(metrics_snapshot())
+
+
+def build_webhook_app(dispatcher: Dispatcher, bot: Bot, secret_token: str) -> web.Application:
+    """
+    aiohttp-приложение с обработчиком вебхука на WEBHOOK_PATH, проверкой для балансировщика на /healthz
+    и метриками экземпляра в JSON на /metrics.
+    Запросы без правильного заголовка X-Telegram-Bot-Api-Secret-Token получают 401.
+    """
+    app = web.Application()
+    app.router.add_get("/healthz", _health)
+    app.router.add_get("/metrics", _metrics)
+    # Обработчик закрывается раньше диспетчера: сначала дорабатывают принятые обновления,
+    # потом хранилище FSM сохраняет состояния.
+    LimitedRequestHandler(dispatcher, bot, secret_token).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot, secret_token: str, port: int = WEBHOOK_PORT) -> None:
+    """Обслуживает вебхук до сигнала остановки или отмены задачи."""
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret_token,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+            drop_pending_updates=False,
+        )
+        print(f"Webhook set to {WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH}")
+
+    # SIGTERM (остановка контейнера, балансировщик выводит экземпляр) и Ctrl+C завершают работу штатно.
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stopped.set)
+        except NotImplementedError:
+            pass
+
+    runner = web.AppRunner(build_webhook_app(dispatcher, bot, secret_token))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, port).start()
+        print(f"Serving webhook on {WEBHOOK_HOST}:{port}{WEBHOOK_PATH}")
+        await stopped.wait()
+        print("Stopping webhook server...")
+    finally:
+        await runner.cleanup()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(signal_number)
+            except NotImplementedError:
+                pass